@@ -4,31 +4,399 @@
 
 import torch
 import numpy
-import time, pdb, argparse, subprocess, os, math, glob
+import time, pdb, argparse, subprocess, os, math, glob, queue, threading, json, socket, resource, hashlib
 import cv2
-import python_speech_features
 
 from scipy import signal
 from scipy.io import wavfile
 from SyncNetModel import *
+from SyncNetMFCC import mfcc_batch
+from SyncNetStore import EmbeddingStore, file_digest
+from SyncNetProfiler import NULL_PROFILER
 from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
 
 
 # ==================== Get OFFSET ====================
 
 def calc_pdist(feat1, feat2, vshift=10):
-    
-    win_size = vshift*2+1
 
-    feat2p = torch.nn.functional.pad(feat2,(0,0,vshift,vshift))
+    # Banded distance matrix [N, 2*vshift+1]: entry (i,k) is the distance between
+    # feat1[i] and the zero-padded feat2p[i+k], as in pairwise_distance (eps=1e-6).
 
+    return calc_pdist_band(feat1, feat2, -vshift, vshift)
+
+def calc_pdist_band(feat1, feat2, lo, hi):
+
+    # Distances for the lags lo..hi, [N, hi-lo+1]: entry (i,k) compares feat1[i]
+    # with feat2[i+lo+k], zero outside feat2. Expanded as |a|^2 + |b|^2 - 2ab with
+    # the eps terms, in float64 to avoid cancellation, so the whole band is a
+    # single batched matrix product.
+
+    win_size = hi-lo+1
+    eps = 1e-6
+    pad = max(abs(lo),abs(hi))
+    rows = slice(lo+pad, lo+pad+len(feat1))
+
+    feat1 = feat1.double()
+    feat2p = torch.nn.functional.pad(feat2.double(),(0,0,pad,pad))
+
+    windows = feat2p.unfold(0, win_size, 1)[rows] # N x D x win_size, view on feat2p
+
+    dot     = torch.bmm(feat1.unsqueeze(1), windows).squeeze(1)
+    sq1     = (feat1 * feat1).sum(1, keepdim=True)
+    sq2     = (feat2p * feat2p).sum(1).unfold(0, win_size, 1)[rows]
+    sum1    = feat1.sum(1, keepdim=True)
+    sum2    = feat2p.sum(1).unfold(0, win_size, 1)[rows]
+
+    dists2  = sq1 + sq2 - 2*dot + 2*eps*(sum1 - sum2) + feat1.size(1)*eps*eps
+
+    return dists2.clamp(min=0).sqrt().float()
+
+def calc_pdist_adaptive(feat1, feat2, vshift_init=3, vshift=15):
+
+    # Coarse-to-fine calc_pdist: starts at +-vshift_init and doubles the window,
+    # computing only the new lags, while the minimum of the mean distance sits on
+    # the window edge. Returns the distances and the final half-width.
+
+    v = min(vshift_init, vshift)
+    dists = calc_pdist_band(feat1, feat2, -v, v)
+
+    while v < vshift:
+        minidx = int(torch.argmin(torch.mean(dists,0)))
+        if 0 < minidx < 2*v:
+            break
+
+        nv = min(2*v, vshift)
+        dists = torch.cat((calc_pdist_band(feat1, feat2, -nv, -v-1), dists, calc_pdist_band(feat1, feat2, v+1, nv)), 1)
+        v = nv
+
+    return dists, v
+
+def calc_pdist_fft(feat1, feat2, maxlag=100, ntop=5, refine=2, nmedian=31):
+
+    # Offset search over +-maxlag without the O(N*maxlag) band. The mean squared
+    # distance of every lag comes from an FFT cross-correlation of the embedding
+    # sequences and prefix sums of the squared norms. The ntop best lags are then
+    # refined with the exact distance within +-refine, and nmedian evenly spaced
+    # lags are evaluated exactly as the background for the confidence median
+    # (with nmedian >= 2*maxlag+1 this is the exhaustive search). The refined lags
+    # cluster around the minimum, so the median is taken over the background only.
+    # Returns the exact distances [N, L], the lags [L] of their columns and the
+    # columns of the background lags.
+
+    n = len(feat1)
+    maxlag = min(maxlag, n-1)
+
+    a = feat1.double().numpy()
+    b = feat2.double().numpy()
+
+    m = 1 << int(math.ceil(math.log(2*n, 2)))
+    corr = numpy.fft.irfft((numpy.conj(numpy.fft.rfft(a, m, axis=0)) * numpy.fft.rfft(b, m, axis=0)).sum(1), m)
+
+    lags = numpy.arange(-maxlag, maxlag+1)
+    csum = numpy.concatenate(([0], numpy.cumsum((b*b).sum(1))))
+    sqb  = csum[numpy.minimum(n+lags, n)] - csum[numpy.maximum(lags, 0)] # zero padding outside feat2
+    msd  = ((a*a).sum() + sqb - 2*corr[lags % m]) / n
+
+    # Best lags, at least refine+1 apart
+    candidates = []
+    for idx in numpy.argsort(msd):
+        if all(abs(lags[idx]-c) > refine for c in candidates):
+            candidates.append(lags[idx])
+        if len(candidates) == ntop:
+            break
+
+    background = set(numpy.round(numpy.linspace(-maxlag, maxlag, nmedian)).astype(int).tolist())
+    exact = set(background)
+    for c in candidates:
+        exact.update(range(max(c-refine, -maxlag), min(c+refine, maxlag)+1))
+    exact = sorted(exact)
+
+    # Exact distances, one band per run of consecutive lags
     dists = []
+    start = 0
+    for i in range(1, len(exact)+1):
+        if i == len(exact) or exact[i] != exact[i-1]+1:
+            dists.append(calc_pdist_band(feat1, feat2, exact[start], exact[i-1]))
+            start = i
+
+    return torch.cat(dists,1), torch.LongTensor(exact), torch.LongTensor([ i for i, lag in enumerate(exact) if lag in background ])
+
+def calc_timeline(dists, lags, window=50, hop=25):
+
+    # Sliding-window offsets from one distance matrix, for drift over long tracks.
+    # The mean distance of every lag over each window is a difference of a
+    # cumulative sum over time. Returns float32 [W, 4] rows of (first frame,
+    # offset, confidence, min dist), with the offset and confidence of calc_offset.
+
+    n = len(dists)
+    window = min(window, n)
+    if window == 0:
+        return numpy.zeros((0,4), dtype=numpy.float32)
+
+    csum = torch.cat((torch.zeros(1,dists.size(1),dtype=torch.float64), torch.cumsum(dists.double(),0)), 0)
+
+    starts = torch.arange(0, n-window+1, hop)
+    mdist  = (csum[starts+window] - csum[starts]) / window
+
+    minval, minidx = torch.min(mdist,1)
+    conf = torch.median(mdist,1)[0] - minval
+
+    return torch.stack((starts.double(), -lags[minidx].double(), conf, minval), 1).float().numpy()
+
+# ==================== PIPE DECODE ====================
+
+def _readinto(stream, buf):
+
+    # Pipes can return short reads, keep reading until buf is full or EOF
+    view = memoryview(buf).cast('B')
+    nread = 0
+    while nread < len(view):
+        n = stream.readinto(view[nread:])
+        if not n:
+            break
+        nread += n
+
+    return nread
+
+def open_video_pipe(videofile):
+
+    # ffmpeg process writing raw BGR frames to stdout, plus (height, width, estimated frame count)
+    cap = cv2.VideoCapture(videofile)
+    width  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    count  = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    command = ['ffmpeg', '-loglevel', 'error', '-i', videofile, '-threads', '1', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    return proc, height, width, count
+
+def close_pipe(proc):
+
+    proc.stdout.close()
+    proc.wait()
+
+def read_video_pipe(videofile):
+
+    # Stream raw BGR frames from ffmpeg into a preallocated uint8 buffer [T,H,W,3]
+    proc, height, width, count = open_video_pipe(videofile)
+
+    images = numpy.empty((max(count,1),height,width,3), dtype=numpy.uint8)
+    nframes = 0
+
+    while True:
+        # Container frame counts are estimates, grow the buffer if needed
+        if nframes == len(images):
+            grown = numpy.empty((2*len(images),height,width,3), dtype=numpy.uint8)
+            grown[:nframes] = images
+            images = grown
+
+        if _readinto(proc.stdout, images[nframes]) < images[nframes].nbytes:
+            break
+        nframes += 1
+
+    close_pipe(proc)
+
+    return images[:nframes]
+
+def read_audio_pipe(videofile, sample_rate=16000):
+
+    # Mono 16-bit PCM straight from ffmpeg, same conversion as the audio.wav dump
+    command = ['ffmpeg', '-loglevel', 'error', '-i', videofile, '-async', '1', '-ac', '1', '-vn', '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', str(sample_rate), 'pipe:1']
+    output = subprocess.run(command, stdout=subprocess.PIPE).stdout
+
+    return sample_rate, numpy.frombuffer(output, dtype=numpy.int16)
+
+def check_lengths(audio, nframes):
+
+    if (float(len(audio))/16000) != (float(nframes)/25) :
+        print("WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."%(float(len(audio))/16000,float(nframes)/25))
+
+# torch.inference_mode needs torch 1.9, fall back to no_grad on older releases
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+# ==================== MEMORY ====================
+
+# Share of the available memory the batches may take, and the memory per window
+# assumed before calibration: the first lip Conv3d alone outputs 96x109x109
+# floats (4.6 MB) per window, and its BatchNorm and pooling add more
+MEMORY_FRACTION = 0.5
+WINDOW_BYTES    = 16<<20
+
+def available_memory():
+
+    # MemAvailable in bytes, or None where /proc/meminfo does not exist
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+
+    return None
+
+def peak_rss():
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def is_oom(e):
+
+    return isinstance(e, MemoryError) or 'out of memory' in str(e) or "can't allocate memory" in str(e)
+
+# ==================== FEATURE FILES ====================
+
+def resize_npy(path, feats, rows, chunk=4096):
+
+    # Copies the first rows of a .npy memmap into a new file of rows rows, chunk by
+    # chunk, and moves it over path. Returns the memmap of the new file.
+    tmpname = path+'.tmp'
+
+    out = numpy.lib.format.open_memmap(tmpname, mode='w+', dtype=feats.dtype, shape=(rows,)+feats.shape[1:])
+
+    n = min(rows, len(feats))
+    for i in range(0, n, chunk):
+        out[i:min(n,i+chunk)] = feats[i:min(n,i+chunk)]
+    out.flush()
+
+    os.replace(tmpname, path)
+
+    return out
+
+def write_progress(path, videofile, windows, complete, frame=None):
+
+    # frame is the frame_digest of frame windows, the first one a resumed run reads
+    with open(path+'.tmp', 'w') as f:
+        json.dump({'videofile': videofile, 'windows': windows, 'complete': complete, 'frame': frame}, f)
+    os.replace(path+'.tmp', path)
+
+def frame_digest(image):
+
+    # Digest of a decoded [H, W, 3] frame
+    return hashlib.sha1(image.tobytes()).hexdigest()
+
+# ==================== TRACK PACKING ====================
+
+# Frames per group of tracks packed together, 1000 frames of 224x224 take 150 MB as uint8.
+# Longer tracks form a group of their own.
+PACK_FRAMES = 1000
+
+def track_length(frames, audio):
+
+    # Usable length of a track in frames
+    return min(len(frames),math.floor(len(audio)/640))
 
-    for i in range(0,len(feat1)):
+def alloc_frames(nframes, shape, min_frames):
 
-        dists.append(torch.nn.functional.pairwise_distance(feat1[[i],:].repeat(win_size, 1), feat2p[i:i+win_size,:]))
+    # uint8 [3, nframes, H, W] buffer for packed frames, halved down to min_frames
+    # frames on an allocation failure
+    while True:
+        try:
+            return numpy.empty((3,nframes)+tuple(shape), dtype=numpy.uint8)
+        except MemoryError:
+            if nframes <= min_frames:
+                raise
+            nframes = max(min_frames, nframes//2)
+            print('WARNING: Out of memory, packing %d frames per group.' % nframes)
 
-    return dists
+def pack_audio(mfccs, lengths):
+
+    # MFCC [13, 4T] of tracks of the given lengths packed back to back, with track
+    # k starting at column 4*starts[k]. Returns it, starts, and the windows that
+    # lie within one track.
+
+    starts  = numpy.cumsum([0]+lengths[:-1])
+    total   = sum(lengths)
+
+    cc = numpy.zeros((mfccs[0].shape[0],4*total), dtype=numpy.float32)
+
+    # Windows starting in the last 5 frames of a track straddle the next track
+    # (or are the trailing window evaluate always drops), so they are not kept
+    valid = numpy.zeros(total, dtype=bool)
+
+    for start, length, mfcc in zip(starts, lengths, mfccs):
+        ncol = min(4*length, mfcc.shape[1])
+        cc[:,4*start:4*start+ncol] = mfcc[:,:ncol]
+        valid[start:start+max(length-5,0)] = True
+
+    return cc, starts, valid
+
+def pack_tracks(images, audios, mfccs):
+
+    # Packs tracks back to back, each cut to its usable length. Returns the uint8
+    # frames [3, T, H, W] with track k starting at frame starts[k], and the
+    # MFCC, starts, lengths and valid windows as in pack_audio.
+
+    lengths = [ track_length(frames, audio) for frames, audio in zip(images, audios) ]
+
+    # Frames stay uint8 in the [3, T, H, W] layout of the lip Conv3d, forward_batch
+    # converts each batch to float just before the forward pass
+    im = numpy.empty((3,sum(lengths))+images[0].shape[1:3], dtype=numpy.uint8)
+
+    cc, starts, valid = pack_audio(mfccs, lengths)
+
+    for start, length, frames in zip(starts, lengths, images):
+        im[:,start:start+length] = numpy.transpose(frames[:length],(3,0,1,2))
+
+    return im, cc, starts, lengths, valid
+
+def unpack_tracks(feat, starts, lengths):
+
+    # Per track rows of embeddings of the packed windows
+    return [ feat[start:start+length-5] for start, length in zip(starts, lengths) ]
+
+# ==================== PIPELINE ====================
+
+def prefetch(iterable, depth=2):
+
+    # Runs iterable in a background thread, up to depth items ahead of the
+    # consumer. Exceptions in the producer are raised in the consumer. Closing
+    # the generator (or an exception in the consumer) stops and joins the
+    # producer, so it does not keep iterable and its items alive.
+    items = queue.Queue(maxsize=depth)
+    stop  = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def lip_worker(nthreads):
+
+    # Single thread that runs the lip tower next to the audio tower, with its own
+    # share of the intra-op threads
+    return ThreadPoolExecutor(max_workers=1, initializer=torch.set_num_threads, initargs=(nthreads,))
 
 # ==================== MAIN DEF ====================
 
@@ -39,166 +407,710 @@ class SyncNetInstance(torch.nn.Module):
 
         self.__S__ = S(num_layers_in_fc_layers = num_layers_in_fc_layers);
 
+        # Identifies the weights and inference variant in the embedding store
+        self.model_key = 'init';
+
+        # Stage timers and counters, replace with an enabled Profiler to collect them
+        self.profiler = NULL_PROFILER;
+
     def evaluate(self, opt, videofile):
 
+        return self.evaluate_tracks(opt, [videofile])[0]
+
+    @inference_mode()
+    def evaluate_tracks(self, opt, videofiles, timeline=False, profile=False):
+
+        # Returns [(offset, conf, dists)] for all tracks of a reference. With
+        # opt.cache_dir set, embeddings of tracks already seen with the same
+        # weights come from the store and only the offset search runs again.
+        # With timeline, each result also has the calc_timeline array over
+        # opt.timeline second windows every opt.timeline_hop seconds. With
+        # profile, returns (results, self.profiler.summary()), the summary
+        # covering everything recorded since the profiler was reset.
+
         self.__S__.eval();
 
-        # ========== ==========
-        # Convert files
-        # ========== ==========
+        feats = [ None for videofile in videofiles ]
 
-        if os.path.exists(os.path.join(opt.tmp_dir,opt.reference)):
-          rmtree(os.path.join(opt.tmp_dir,opt.reference))
+        if getattr(opt, 'cache_dir', ''):
+            store = EmbeddingStore(opt.cache_dir, int(opt.cache_size*(1<<30)))
+            frames = 'raw' if getattr(opt, 'stream', False) or getattr(opt, 'decode', 'disk') == 'pipe' else 'disk'
+            keys  = [ store.key(videofile, self.model_key, frames) for videofile in videofiles ]
+            feats = [ store.get(key) for key in keys ]
 
-        os.makedirs(os.path.join(opt.tmp_dir,opt.reference))
+        misses = [ idx for idx, feat in enumerate(feats) if feat is None ]
 
-        command = ("ffmpeg -y -i %s -threads 1 -f image2 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'%06d.jpg'))) 
-        output = subprocess.call(command, shell=True, stdout=None)
+        if len(misses) < len(videofiles):
+            print('Embedding store: %d of %d tracks cached.' % (len(videofiles)-len(misses), len(videofiles)))
+
+        for idx, feat in zip(misses, self.embed_tracks(opt, [ videofiles[idx] for idx in misses ])):
+            feats[idx] = feat
+            if getattr(opt, 'cache_dir', ''):
+                store.put(keys[idx], *feat)
 
-        command = ("ffmpeg -y -i %s -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))) 
-        output = subprocess.call(command, shell=True, stdout=None)
-        
         # ========== ==========
-        # Load video 
+        # Compute offsets
         # ========== ==========
 
-        images = []
-        
-        flist = glob.glob(os.path.join(opt.tmp_dir,opt.reference,'*.jpg'))
-        flist.sort()
+        results = [ self.calc_offset(opt, im_feat, cc_feat) for im_feat, cc_feat in feats ]
 
-        for fname in flist:
-            images.append(cv2.imread(fname))
+        if timeline:
+            # Every lag in +-vshift, whichever search found the global offset. The
+            # full search already computed that band, the others compute it here.
+            lags = torch.arange(-opt.vshift,opt.vshift+1)
+            full = getattr(opt, 'search', 'full') == 'full'
+            results = [ result + (calc_timeline(torch.from_numpy(result[2]) if full else calc_pdist(im_feat,cc_feat,vshift=opt.vshift), lags,
+                                                window=int(round(opt.timeline*25)), hop=max(int(round(opt.timeline_hop*25)),1)),)
+                        for result, (im_feat, cc_feat) in zip(results, feats) ]
+
+        if profile:
+            return results, self.profiler.summary()
+
+        return results
+
+    def embed_tracks(self, opt, videofiles):
+
+        # Embeds the tracks of a reference with shared batches: the tracks are
+        # packed back to back, windows are batched across track boundaries, and the
+        # embeddings are scattered back per track. Tracks are packed into groups of
+        # up to PACK_FRAMES frames as they are decoded, and each group is embedded
+        # before the next one is decoded, so memory is bounded by a group rather
+        # than the whole reference. Returns [(im_feat, cc_feat)].
+
+        if getattr(opt, 'stream', False):
+            return [ self.embed_stream(opt, videofile) for videofile in videofiles ]
+
+        feats   = []
+        im      = None # packed frames of the current group
+        audios  = []
+        lengths = []
+        budget  = PACK_FRAMES
+
+        for videofile in videofiles:
+
+            # ========== ==========
+            # Load video and audio
+            # ========== ==========
+
+            t0 = time.time()
+            if getattr(opt, 'decode', 'disk') == 'pipe':
+                frames = read_video_pipe(videofile)
+                sample_rate, audio = read_audio_pipe(videofile)
+            else:
+                frames, sample_rate, audio = self.convert_files(opt, videofile)
+            self.profiler.add('decode', time.time()-t0, len(frames))
+
+            # ========== ==========
+            # Check audio and video input length
+            # ========== ==========
 
-        im = numpy.stack(images,axis=3)
-        im = numpy.expand_dims(im,axis=0)
-        im = numpy.transpose(im,(0,3,4,1,2))
+            check_lengths(audio, len(frames))
 
-        imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
+            # ========== ==========
+            # Pack the track, after embedding the group if it is full
+            # ========== ==========
+
+            length = track_length(frames, audio)
+
+            if im is not None and (sum(lengths)+length > im.shape[1] or frames.shape[1:3] != im.shape[2:]):
+                feats += self.embed_group(opt, im, audios, lengths, sample_rate)
+                im = None
+
+            if im is None:
+                im = alloc_frames(max(budget,length), frames.shape[1:3], length)
+                budget = min(budget, im.shape[1])
+                audios, lengths = [], []
+
+            start = sum(lengths)
+            im[:,start:start+length] = numpy.transpose(frames[:length],(3,0,1,2))
+            audios.append(audio)
+            lengths.append(length)
+
+            del frames
+
+        if im is not None:
+            feats += self.embed_group(opt, im, audios, lengths, sample_rate)
+
+        return feats
+
+    def embed_group(self, opt, im, audios, lengths, sample_rate):
+
+        # Embeds tracks whose frames are packed at the start of im
+
+        with self.profiler.stage('mfcc', len(audios)):
+            mfccs = mfcc_batch(audios, sample_rate)
+
+        cc, starts, valid = pack_audio(mfccs, lengths)
+
+        return self.embed_packed(opt, im[:,:sum(lengths)], cc, starts, lengths, valid)
+
+    def embed_packed(self, opt, im, cc, starts, lengths, valid):
+
+        # Embeds the windows of tracks packed by pack_tracks, in batches across
+        # track boundaries. Returns [(im_feat, cc_feat)] per track.
+
+        total = len(valid)
+
+        imtv = torch.from_numpy(im)[None]
+        cct  = torch.from_numpy(cc[None,None])
 
         # ========== ==========
-        # Load audio
+        # Generate video and audio feats
         # ========== ==========
 
-        sample_rate, audio = wavfile.read(os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))
-        mfcc = zip(*python_speech_features.mfcc(audio,sample_rate))
-        mfcc = numpy.stack([numpy.array(i) for i in mfcc])
+        lastframe = total-4
+        im_feat = None
+        cc_feat = None
+        nbatch  = 0
+        stages  = dict(prepare=0., lip=0., audio=0., wait=0.)
+
+        def batches(first):
+            for i in range(first,lastframe,opt.batch_size):
 
-        cc = numpy.expand_dims(numpy.expand_dims(mfcc,axis=0),axis=0)
-        cct = torch.autograd.Variable(torch.from_numpy(cc.astype(float)).float())
+                vframes = range(i,min(lastframe,i+opt.batch_size))
+                if not valid[vframes[0]:vframes[-1]+1].any():
+                    continue
+
+                t0 = time.time()
+                im_in, cc_in = self.slice_batch(imtv, cct, 0, vframes)
+                stages['prepare'] += time.time()-t0
+
+                yield vframes, im_in, cc_in
+
+        # Pipelined: batches are sliced and converted to float in a background
+        # thread, and the lip tower runs in a worker next to the audio tower,
+        # each with its share of the intra-op threads
+        pipeline = getattr(opt, 'pipeline', False)
+
+        # On an allocation failure the batch size is halved and the remaining
+        # windows are batched again, from the first window not yet embedded
+        first = 0
+
+        tS = time.time()
+        while True:
+            if pipeline:
+                nthreads = torch.get_num_threads()
+                aud_threads = max(1, nthreads//4)
+                worker = lip_worker(max(1, nthreads-aud_threads))
+                torch.set_num_threads(aud_threads)
+
+            batch_iter = prefetch(batches(first)) if pipeline else batches(first)
+
+            try:
+                for vframes, im_in, cc_in in batch_iter:
+
+                    if pipeline:
+                        im_out, cc_out = self.forward_towers_concurrent(worker, im_in, cc_in, len(vframes), stages)
+                    else:
+                        im_out, cc_out = self.forward_towers(im_in, cc_in, len(vframes), stages)
+
+                    if im_feat is None:
+                        im_feat = torch.zeros(total, im_out.size(1))
+                        cc_feat = torch.zeros(total, cc_out.size(1))
+
+                    im_feat[vframes[0]:vframes[-1]+1] = im_out
+                    cc_feat[vframes[0]:vframes[-1]+1] = cc_out
+                    nbatch += 1
+                    first = vframes[-1]+1
+                break
+            except (RuntimeError, MemoryError) as e:
+                if not is_oom(e) or opt.batch_size == 1:
+                    raise
+                opt.batch_size = max(1, opt.batch_size//2)
+                print('WARNING: Out of memory, batch size reduced to %d.' % opt.batch_size)
+            finally:
+                # Joins the prefetch thread before a retry, it holds the packed clip
+                batch_iter.close()
+                if pipeline:
+                    worker.shutdown()
+                    torch.set_num_threads(nthreads)
+
+        print('Compute time %.3f sec. (%d tracks, %d windows, %d batches)' % (time.time()-tS, len(lengths), valid.sum(), nbatch))
+        print('Stage times: prepare %.3f, lip %.3f, audio %.3f, wait %.3f sec.%s' % (stages['prepare'], stages['lip'], stages['audio'], stages['wait'], ' (pipelined)' if pipeline else ''))
+
+        for name in (['prepare', 'lip', 'audio', 'wait'] if pipeline else ['prepare', 'lip', 'audio']):
+            self.profiler.add(name, stages[name], int(valid.sum()))
+
+        return list(zip(unpack_tracks(im_feat, starts, lengths), unpack_tracks(cc_feat, starts, lengths)))
+
+    def embed_stream(self, opt, videofile):
 
         # ========== ==========
-        # Check audio and video input length
+        # Audio is small, decode it and compute MFCC up front
         # ========== ==========
 
-        if (float(len(audio))/16000) != (float(len(images))/25) :
-            print("WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."%(float(len(audio))/16000,float(len(images))/25))
+        t0 = time.time()
+        sample_rate, audio = read_audio_pipe(videofile)
+        self.profiler.add('decode', time.time()-t0, 0)
+
+        with self.profiler.stage('mfcc'):
+            cct = self.compute_mfcc(audio, sample_rate)
+
+        audio_lastframe = math.floor(len(audio)/640)-5
 
-        min_length = min(len(images),math.floor(len(audio)/640))
-        
         # ========== ==========
-        # Generate video and audio feats
+        # Read frames in rolling windows of batch_size+5 frames: batch_size
+        # windows need batch_size+4 frames, plus one lookahead frame so the
+        # last window of the clip is dropped exactly as in evaluate
         # ========== ==========
 
-        lastframe = min_length-5
+        proc, height, width, count = open_video_pipe(videofile)
+
+        frames  = numpy.empty((opt.batch_size+5,height,width,3), dtype=numpy.uint8)
+        filled  = 0
+        nframes = 0
+        i       = 0
         im_feat = []
         cc_feat = []
+        stages  = dict(lip=0., audio=0.)
 
         tS = time.time()
-        for i in range(0,lastframe,opt.batch_size):
-            
-            im_batch = [ imtv[:,:,vframe:vframe+5,:,:] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            im_in = torch.cat(im_batch,0)
-            im_out  = self.__S__.forward_lip(im_in);
-            im_feat.append(im_out.data.cpu())
-
-            cc_batch = [ cct[:,:,:,vframe*4:vframe*4+20] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            cc_in = torch.cat(cc_batch,0)
-            cc_out  = self.__S__.forward_aud(cc_in)
-            cc_feat.append(cc_out.data.cpu())
+        while True:
+            eof = _readinto(proc.stdout, frames[filled]) < frames[filled].nbytes
+            if not eof:
+                filled  += 1
+                nframes += 1
+
+            if filled == len(frames) or eof:
+                nwin = min(filled-5, audio_lastframe-i)
+                if nwin > 0:
+                    im = numpy.transpose(frames[None,:nwin+4],(0,4,1,2,3))
+                    imtv = torch.from_numpy(numpy.ascontiguousarray(im))
+
+                    im_out, cc_out = self.forward_batch(imtv, cct, i, range(i,i+nwin), stages)
+                    im_feat.append(im_out)
+                    cc_feat.append(cc_out)
+                    i += nwin
+
+                if eof or i >= audio_lastframe:
+                    break
+
+                frames[:5] = frames[filled-5:filled]
+                filled = 5
+
+        close_pipe(proc)
 
         im_feat = torch.cat(im_feat,0)
         cc_feat = torch.cat(cc_feat,0)
 
+        print('Compute time %.3f sec.' % (time.time()-tS))
+
+        # Frames are read between the forward passes, the rest of the loop is decoding
+        self.profiler.add('decode', time.time()-tS-stages['lip']-stages['audio'], nframes)
+        self.profiler.add('lip', stages['lip'], len(im_feat))
+        self.profiler.add('audio', stages['audio'], len(cc_feat))
+
+        check_lengths(audio, nframes)
+
+        return im_feat, cc_feat
+
+    def compute_mfcc(self, audio, sample_rate):
+
+        mfcc = mfcc_batch([audio],sample_rate)[0] # 13 x T, float32
+
+        cct = torch.from_numpy(mfcc[None,None]) # 1 x 1 x 13 x T
+
+        return cct
+
+    def forward_batch(self, imtv, cct, start, vframes, stages=None):
+
+        im_in, cc_in = self.slice_batch(imtv, cct, start, vframes)
+
+        return self.forward_towers(im_in, cc_in, len(vframes), stages)
+
+    def slice_batch(self, imtv, cct, start, vframes):
+
+        # imtv holds the uint8 frames from index start onwards, vframes is a range of absolute
+        # window indices; its windows share frames, so run them as one clip
+        im_in = imtv[:,:,vframes[0]-start:vframes[-1]-start+5,:,:].float()
+        cc_in = cct[:,:,:,vframes[0]*4:vframes[-1]*4+20]
+
+        return im_in, cc_in
+
+    def forward_towers(self, im_in, cc_in, nwin, stages=None):
+
+        t0 = time.time()
+        im_out  = self.__S__.forward_lip_seq(im_in);
+        t1 = time.time()
+        cc_out  = self.__S__.forward_aud_seq(cc_in, nwin)
+
+        if stages is not None:
+            stages['lip']   += t1-t0
+            stages['audio'] += time.time()-t1
+
+        return im_out.cpu(), cc_out.cpu()
+
+    def forward_towers_concurrent(self, worker, im_in, cc_in, nwin, stages):
+
+        # Grad mode is per thread and new threads start with grad enabled, so the
+        # worker enters inference mode for every batch
+        def lip():
+            t0 = time.time()
+            with inference_mode():
+                im_out = self.__S__.forward_lip_seq(im_in)
+            return im_out, time.time()-t0
+
+        future = worker.submit(lip)
+
+        t0 = time.time()
+        cc_out  = self.__S__.forward_aud_seq(cc_in, nwin)
+        t1 = time.time()
+        im_out, lip_time = future.result()
+
+        stages['lip']   += lip_time
+        stages['audio'] += t1-t0
+        stages['wait']  += time.time()-t1
+
+        return im_out.cpu(), cc_out.cpu()
+
+    def calc_offset(self, opt, im_feat, cc_feat):
+
         # ========== ==========
         # Compute offset
         # ========== ==========
-            
-        print('Compute time %.3f sec.' % (time.time()-tS))
 
-        dists = calc_pdist(im_feat,cc_feat,vshift=opt.vshift)
-        mdist = torch.mean(torch.stack(dists,1),1)
+        # dists has one column per lag in lags; a lag of k means the audio matches k frames later.
+        # The confidence median is over the columns in background, every lag except for fft.
+        search = getattr(opt, 'search', 'full')
+        background = None
+
+        t0 = time.time()
+        if search == 'fft':
+            dists, lags, background = calc_pdist_fft(im_feat,cc_feat,maxlag=opt.vshift)
+        elif search == 'adaptive':
+            dists, vshift = calc_pdist_adaptive(im_feat,cc_feat,vshift_init=opt.vshift_init,vshift=opt.vshift)
+            lags = torch.arange(-vshift,vshift+1)
+        else:
+            dists = calc_pdist(im_feat,cc_feat,vshift=opt.vshift)
+            lags = torch.arange(-opt.vshift,opt.vshift+1)
+        self.profiler.add('distance', time.time()-t0, dists.numel())
+
+        mdist = torch.mean(dists,0)
 
         minval, minidx = torch.min(mdist,0)
+        median = torch.median(mdist if background is None else mdist[background])
 
-        offset = opt.vshift-minidx
-        conf   = torch.median(mdist) - minval
+        offset = -lags[minidx]
+        conf   = median - minval
 
-        fdist   = numpy.stack([dist[minidx].numpy() for dist in dists])
+        fdist   = dists[:,minidx].numpy()
         # fdist   = numpy.pad(fdist, (3,3), 'constant', constant_values=15)
-        fconf   = torch.median(mdist).numpy() - fdist
+        fconf   = median.numpy() - fdist
         fconfm  = signal.medfilt(fconf,kernel_size=9)
         
         numpy.set_printoptions(formatter={'float': '{: 0.3f}'.format})
         print('Framewise conf: ')
         print(fconfm)
         print('AV offset: \t%d \nMin dist: \t%.3f\nConfidence: \t%.3f' % (offset,minval,conf))
+        print('Dist evals: \t%d (%d lags in %+d..%+d)' % (dists.numel(),len(lags),lags[0],lags[-1]))
 
-        dists_npy = numpy.array([ dist.numpy() for dist in dists ])
+        dists_npy = dists.numpy()
         return offset.numpy(), conf.numpy(), dists_npy
 
-    def extract_feature(self, opt, videofile):
+    def convert_files(self, opt, videofile):
 
-        self.__S__.eval();
-        
         # ========== ==========
-        # Load video 
+        # Convert files
         # ========== ==========
-        cap = cv2.VideoCapture(videofile)
 
-        frame_num = 1;
-        images = []
-        while frame_num:
-            frame_num += 1
-            ret, image = cap.read()
-            if ret == 0:
-                break
+        if os.path.exists(os.path.join(opt.tmp_dir,opt.reference)):
+          rmtree(os.path.join(opt.tmp_dir,opt.reference))
 
-            images.append(image)
+        os.makedirs(os.path.join(opt.tmp_dir,opt.reference))
 
-        im = numpy.stack(images,axis=3)
-        im = numpy.expand_dims(im,axis=0)
-        im = numpy.transpose(im,(0,3,4,1,2))
+        command = ("ffmpeg -y -i %s -threads 1 -f image2 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'%06d.jpg'))) 
+        output = subprocess.call(command, shell=True, stdout=None)
 
-        imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
+        command = ("ffmpeg -y -i %s -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))) 
+        output = subprocess.call(command, shell=True, stdout=None)
         
         # ========== ==========
-        # Generate video feats
+        # Load video 
         # ========== ==========
 
-        lastframe = len(images)-4
-        im_feat = []
+        images = []
+        
+        flist = glob.glob(os.path.join(opt.tmp_dir,opt.reference,'*.jpg'))
+        flist.sort()
+
+        for fname in flist:
+            images.append(cv2.imread(fname))
+
+        sample_rate, audio = wavfile.read(os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))
+
+        return numpy.stack(images,axis=0), sample_rate, audio
+
+    @inference_mode()
+    def extract_feature(self, opt, videofile):
+
+        self.__S__.eval();
+
+        im_feat = [ im_out for _, im_out, _ in self.iter_lip_features(opt, videofile) ]
+
+        return torch.cat(im_feat,0)
+
+    def iter_lip_features(self, opt, videofile, start=0, digest=None):
+
+        # Yields (first window, lip features, frame_digest of the frame after the
+        # last window's first frame) batch by batch. Frames are decoded with
+        # cv2.VideoCapture into a rolling uint8 [3, batch_size+4, H, W] buffer, so
+        # memory does not grow with the video. Window i covers frames i to i+4, the
+        # first start windows are skipped.
+
+        self.__S__.eval();
+
+        # Seeking can land a few frames off on B-frame or variable frame rate streams
+        # while still reporting start, so the frame found there must match digest,
+        # the digest of frame start. Otherwise the skipped frames are decoded.
+        cap = cv2.VideoCapture(videofile)
+        first = None
+        if start > 0:
+            if digest is not None and cap.set(cv2.CAP_PROP_POS_FRAMES, start):
+                ret, first = cap.read()
+                if not ret or frame_digest(first) != digest:
+                    first = None
+
+            if first is None:
+                cap.release()
+                cap = cv2.VideoCapture(videofile)
+                for _ in range(start):
+                    if not cap.grab():
+                        break
+
+        frames = None
+        filled = 0
+        i      = start
+
+        while True:
+            if first is not None:
+                ret, image, first = True, first, None
+            else:
+                ret, image = cap.read()
+
+            if ret:
+                if frames is None:
+                    frames = numpy.empty((3,opt.batch_size+4)+image.shape[:2], dtype=numpy.uint8)
+                frames[:,filled] = numpy.transpose(image,(2,0,1))
+                filled += 1
+
+            if not ret or filled == opt.batch_size+4:
+                if filled > 4:
+                    with inference_mode():
+                        im_out = self.__S__.forward_lipfeat_seq(torch.from_numpy(frames[None,:,:filled]).float())
+                    yield i, im_out.cpu(), frame_digest(numpy.transpose(frames[:,filled-4],(1,2,0)))
+                    i += filled-4
+
+                if not ret:
+                    break
+
+                frames[:,:4] = frames[:,filled-4:filled]
+                filled = 4
+
+        cap.release()
+
+    def extract_feature_to_file(self, opt, videofile, outfile):
+
+        # Writes the lip features to a preallocated float32 .npy memmap, sized from the
+        # container frame count and resized if that was wrong. The number of windows
+        # written is kept in outfile.json after every batch, and an interrupted
+        # extraction of the same video resumes from there. Returns the window count.
+
+        progress_file = outfile+'.json'
+
+        progress = {}
+        if os.path.exists(progress_file):
+            with open(progress_file) as f:
+                progress = json.load(f)
+
+        feats  = None
+        done   = 0
+        digest = None
+
+        if progress.get('videofile') == videofile and os.path.exists(outfile):
+            if progress['complete']:
+                print('Features already extracted to %s.' % outfile)
+                return progress['windows']
+
+            feats = numpy.load(outfile, mmap_mode='r+')
+            done   = progress['windows']
+            digest = progress.get('frame')
+            print('Resuming %s at window %d.' % (outfile, done))
 
         tS = time.time()
-        for i in range(0,lastframe,opt.batch_size):
-            
-            im_batch = [ imtv[:,:,vframe:vframe+5,:,:] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            im_in = torch.cat(im_batch,0)
-            im_out  = self.__S__.forward_lipfeat(im_in);
-            im_feat.append(im_out.data.cpu())
+        for i, im_out, digest in self.iter_lip_features(opt, videofile, start=done, digest=digest):
+            if feats is None:
+                cap = cv2.VideoCapture(videofile)
+                count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                cap.release()
+                feats = numpy.lib.format.open_memmap(outfile, mode='w+', dtype=numpy.float32, shape=(max(count-4,len(im_out)),im_out.size(1)))
 
-        im_feat = torch.cat(im_feat,0)
+            if i+len(im_out) > len(feats):
+                feats = resize_npy(outfile, feats, max(i+len(im_out),2*len(feats)))
+
+            feats[i:i+len(im_out)] = im_out.numpy()
+            feats.flush()
+
+            done = i+len(im_out)
+            write_progress(progress_file, videofile, done, False, digest)
+
+        if feats is None:
+            numpy.save(outfile, numpy.zeros((0,0), dtype=numpy.float32))
+        elif done < len(feats):
+            feats = resize_npy(outfile, feats, done)
+
+        write_progress(progress_file, videofile, done, True, digest)
+
+        print('Extracted %d windows to %s in %.3f sec.' % (done, outfile, time.time()-tS))
+
+        return done
+
+    def autoBatchSize(self, opt, cache_file='~/.cache/syncnet/batch_size.json'):
+
+        # Sets opt.batch_size from a throughput calibration, cached per host, weights
+        # and thread count, and capped by the memory available now
+        cache_file = os.path.expanduser(cache_file)
+        key = '%s:%s:%d' % (socket.gethostname(), self.model_key, torch.get_num_threads())
+
+        cache = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                cache = json.load(f)
+
+        if key in cache:
+            batch_size, window_bytes = cache[key]
+        else:
+            batch_size, window_bytes = self.calibrate_batch_size()
+
+            cache[key] = [batch_size, window_bytes]
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file+'.tmp', 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(cache_file+'.tmp', cache_file)
+
+        memory = available_memory()
+        if memory is not None:
+            batch_size = max(1, min(batch_size, int(memory*MEMORY_FRACTION/window_bytes)))
+
+        opt.batch_size = batch_size
+
+        print('Batch size %d (auto, %.1f MB per window).' % (batch_size, window_bytes/(1<<20)))
+
+        return batch_size
+
+    @inference_mode()
+    def calibrate_batch_size(self, candidates=(8,16,32,64,128,256), tolerance=0.05):
+
+        # Windows per second of synthetic batches of doubling size, until the next
+        # size would not fit in memory or an allocation fails. The smallest size
+        # within tolerance of the best throughput wins. The memory per window is
+        # the peak RSS growth between consecutive sizes.
+        if hasattr(self.__S__, 'eval'):
+            self.__S__.eval();
+
+        memory = available_memory()
+        window_bytes = WINDOW_BYTES
+        measured = []
+        rates = {}
+        prev = 0
+
+        for batch_size in candidates:
+            if memory is not None and batch_size*window_bytes > memory*MEMORY_FRACTION:
+                break
+
+            im_in = torch.randint(0, 256, (1,3,batch_size+4,224,224), dtype=torch.uint8).float()
+            cc_in = torch.randn(1,1,13,4*(batch_size-1)+20)
+
+            rss = peak_rss()
+            try:
+                self.forward_towers(im_in, cc_in, batch_size) # warm-up
+                tS = time.time()
+                self.forward_towers(im_in, cc_in, batch_size)
+                rates[batch_size] = batch_size/(time.time()-tS)
+            except (RuntimeError, MemoryError) as e:
+                if not is_oom(e):
+                    raise
+                break
+
+            if peak_rss() > rss:
+                measured.append((peak_rss()-rss)/(batch_size-prev))
+                window_bytes = max(measured)
+            prev = batch_size
+
+            print('Batch size %d: %.1f windows/sec.' % (batch_size, rates[batch_size]))
+
+        if not rates:
+            return 1, window_bytes
+
+        best = max(rates.values())
+
+        return min(b for b, rate in rates.items() if rate >= (1-tolerance)*best), window_bytes
+
+    def quantizeModel(self, opt, videofiles, static=True):
 
         # ========== ==========
-        # Compute offset
+        # Calibrate on the first batch of windows of each clip
         # ========== ==========
-            
-        print('Compute time %.3f sec.' % (time.time()-tS))
 
-        return im_feat
+        calibration = []
+
+        for videofile in videofiles:
+            proc, height, width, count = open_video_pipe(videofile)
+            frames = numpy.empty((opt.batch_size+4,height,width,3), dtype=numpy.uint8)
+            nframes = 0
+            while nframes < len(frames) and _readinto(proc.stdout, frames[nframes]) == frames[nframes].nbytes:
+                nframes += 1
+            close_pipe(proc)
+
+            sample_rate, audio = read_audio_pipe(videofile)
+
+            nwin = min(nframes,math.floor(len(audio)/640))-4
+            if nwin <= 0:
+                continue
+
+            im = numpy.transpose(frames[None,:nwin+4],(0,4,1,2,3))
+            lip = torch.from_numpy(numpy.ascontiguousarray(im)).float()
+
+            mfcc = torch.from_numpy(mfcc_batch([audio],sample_rate)[0][None,None])
+            aud = torch.cat([ mfcc[:,:,:,vframe*4:vframe*4+20] for vframe in range(nwin) ],0)
 
+            calibration.append((lip, aud))
+
+        if static and not calibration:
+            print('WARNING: No calibration clips could be decoded, quantizing dynamically.')
+            static = False
+
+        self.__S__ = quantize(self.__S__, calibration, static=static);
+
+        # Trunks the backend cannot run quantized stay in fp32
+        if static and not any(isinstance(trunk, QuantTrunk) for trunk in [self.__S__.netcnnlip, self.__S__.netcnnaud]):
+            print('WARNING: Neither conv trunk could be quantized statically, the model is quantized dynamically.')
+            static = False
+
+        self.model_key += ':int8-%s' % ('static' if static else 'dynamic');
+
+        print('Quantized model (%s, %d calibration clips).' % ('static' if static else 'dynamic', len(calibration) if static else 0))
+
+    def loadParameters(self, path, fuse=False, compiled=True, engine='torch'):
+
+        digest = file_digest(path);
+        self.model_key = digest + (':fused' if fuse else '');
+
+        # Graphs written by export_model.py next to the weights replace the eager model,
+        # if they were exported from these weights. The graph's key is what it was
+        # exported with, which may differ from the fuse argument.
+        prefix = os.path.splitext(path)[0]
+        if compiled and os.path.exists(prefix+'.ts'):
+            info = load_export_info(prefix)
+            if info is None or info.get('weights') != digest:
+                print("WARNING: %s was not exported from %s, ignoring it. Run export_model.py again."%(prefix+'.ts',path))
+            else:
+                if info['fuse'] != fuse:
+                    print("WARNING: %s was exported %s --fuse_bn, using it as exported."%(prefix+'.ts','with' if info['fuse'] else 'without'))
+                self.__S__ = load_compiled(prefix, engine=engine);
+                self.model_key = info['weights'] + (':fused' if info['fuse'] else '') + ':compiled-%s' % engine;
+                print("Compiled model %s loaded (%s)."%(prefix,engine))
+                return
 
-    def loadParameters(self, path):
         loaded_state = torch.load(path, map_location=lambda storage, loc: storage);
 
         self_state = self.__S__.state_dict();
@@ -206,3 +1118,6 @@ class SyncNetInstance(torch.nn.Module):
         for name, param in loaded_state.items():
 
             self_state[name].copy_(param);
+
+        if fuse:
+            self.__S__ = fuse_bn(self.__S__);
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Batched MFCC frontend, numerically equivalent to python_speech_features.mfcc
+# with its default parameters (25 ms windows, 10 ms step, 26 filters, 13 cepstra)
+
+import math
+import numpy
+
+from functools import lru_cache
+
+WINLEN      = 0.025
+WINSTEP     = 0.01
+NUMCEP      = 13
+NFILT       = 26
+PREEMPH     = 0.97
+CEPLIFTER   = 22
+EPS         = numpy.finfo(float).eps
+
+# ==================== FILTERBANKS ====================
+
+def hz2mel(hz):
+    return 2595 * numpy.log10(1+hz/700.)
+
+def mel2hz(mel):
+    return 700*(10**(mel/2595.0)-1)
+
+def calc_nfft(samplerate, winlen=WINLEN):
+
+    window_length_samples = winlen * samplerate
+    nfft = 1
+    while nfft < window_length_samples:
+        nfft *= 2
+
+    return nfft
+
+def get_filterbanks(nfilt, nfft, samplerate, lowfreq=0, highfreq=None):
+
+    highfreq = highfreq or samplerate/2
+
+    melpoints = numpy.linspace(hz2mel(lowfreq),hz2mel(highfreq),nfilt+2)
+    bins = numpy.floor((nfft+1)*mel2hz(melpoints)/samplerate)
+
+    fbank = numpy.zeros([nfilt,nfft//2+1])
+    for j in range(0,nfilt):
+        for i in range(int(bins[j]), int(bins[j+1])):
+            fbank[j,i] = (i - bins[j]) / (bins[j+1]-bins[j])
+        for i in range(int(bins[j+1]), int(bins[j+2])):
+            fbank[j,i] = (bins[j+2]-i) / (bins[j+2]-bins[j+1])
+
+    return fbank
+
+@lru_cache(maxsize=None)
+def get_matrices(samplerate, nfilt=NFILT, numcep=NUMCEP, ceplifter=CEPLIFTER):
+
+    # Mel filterbank [nfft//2+1, nfilt] and orthonormal DCT-II with the lifter folded in [nfilt, numcep]
+    nfft = calc_nfft(samplerate)
+    fbank = get_filterbanks(nfilt, nfft, samplerate).T
+
+    n = numpy.arange(nfilt)
+    k = numpy.arange(numcep)
+    dct = numpy.cos(numpy.pi * numpy.outer(2*n+1, k) / (2*nfilt)) * numpy.sqrt(2.0/nfilt)
+    dct[:,0] /= numpy.sqrt(2.0)
+
+    lift = 1 + (ceplifter/2.)*numpy.sin(numpy.pi*k/ceplifter)
+
+    return nfft, numpy.ascontiguousarray(fbank), dct * lift
+
+# ==================== MFCC ====================
+
+def frame_signal(signal, frame_len, frame_step):
+
+    # Pre-emphasis, zero padding to whole frames, then a strided view of the frames
+    signal = numpy.asarray(signal, dtype=numpy.float64)
+    signal = numpy.append(signal[0], signal[1:] - PREEMPH*signal[:-1])
+
+    slen = len(signal)
+    if slen <= frame_len:
+        numframes = 1
+    else:
+        numframes = 1 + int(math.ceil((1.0*slen - frame_len) / frame_step))
+
+    padded = numpy.zeros(int((numframes-1)*frame_step + frame_len))
+    padded[:slen] = signal
+
+    return numpy.lib.stride_tricks.as_strided(padded, shape=(numframes, frame_len), strides=(frame_step*padded.itemsize, padded.itemsize))
+
+def mfcc_batch(signals, samplerate=16000):
+
+    # MFCC for a list of 1-D audio buffers, computed with one FFT and one pair of
+    # matrix products over the frames of all buffers. Returns a list of float32
+    # arrays in the (13, T) layout forward_aud expects.
+    nfft, fbank, dct = get_matrices(samplerate)
+
+    frame_len  = int(math.floor(WINLEN*samplerate + 0.5)) # round half up
+    frame_step = int(math.floor(WINSTEP*samplerate + 0.5))
+
+    frames = [ frame_signal(signal, frame_len, frame_step) for signal in signals ]
+    counts = [ len(f) for f in frames ]
+
+    frames = numpy.concatenate(frames, 0)
+
+    pspec  = 1.0/nfft * numpy.square(numpy.absolute(numpy.fft.rfft(frames, nfft)))
+    energy = numpy.sum(pspec, 1)
+    energy = numpy.where(energy == 0, EPS, energy)
+
+    feat = numpy.dot(pspec, fbank)
+    feat = numpy.where(feat == 0, EPS, feat)
+    feat = numpy.dot(numpy.log(feat), dct)
+    feat[:,0] = numpy.log(energy)
+
+    feats = numpy.split(feat, numpy.cumsum(counts)[:-1], 0)
+
+    return [ numpy.ascontiguousarray(f.T, dtype=numpy.float32) for f in feats ]
+
+def mfcc(signal, samplerate=16000):
+
+    return mfcc_batch([signal], samplerate)[0]
@@ -1,6 +1,9 @@
 #!/usr/bin/python
 #-*- coding: utf-8 -*-
 
+import os
+import copy
+import json
 import torch
 import torch.nn as nn
 
@@ -13,6 +16,112 @@ def load(filename):
     net = torch.load(filename)
     return net;
     
+def fuse_bn(model):
+
+    # Inference-only copy of S with every BatchNorm folded into the conv/linear
+    # layer before it (w' = w*g/sqrt(v+e), b' = (b-m)*g/sqrt(v+e) + beta) and
+    # replaced by an Identity, so the Sequential indices stay the same.
+    fused = copy.deepcopy(model).eval()
+
+    with torch.no_grad():
+        for seq in [fused.netcnnaud, fused.netfcaud, fused.netfclip, fused.netcnnlip]:
+            for i in range(1, len(seq)):
+                bn, layer = seq[i], seq[i-1]
+                if not isinstance(bn, nn.modules.batchnorm._BatchNorm):
+                    continue
+                if not isinstance(layer, (nn.Conv2d, nn.Conv3d, nn.Linear)):
+                    continue
+
+                scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+                layer.weight.mul_(scale.view([-1] + [1]*(layer.weight.dim()-1)))
+                layer.bias.copy_((layer.bias - bn.running_mean) * scale + bn.bias)
+
+                seq[i] = nn.Identity()
+
+    return fused;
+
+def aud_windows(x, nwin, width=20, stride=4):
+
+    # 1 x 1 x 13 x L MFCC strip -> N x 1 x 13 x width windows every stride columns
+    return x[:,:,:,:stride*(nwin-1)+width].unfold(3, width, stride).permute(3,0,1,2,4).reshape(nwin, x.size(1), x.size(2), width);
+
+def strip_cols(strip, nwin, lo, hi, step):
+
+    # Columns lo..hi-1 of nwin windows, window w starting at column step*w of the 1 x C x H x L strip
+    return strip[:,:,:,lo:].unfold(3, hi-lo, step)[0].permute(2,0,1,3)[:nwin];
+
+def conv_cols(block, x, left, right):
+
+    # Conv block (conv, bn, relu) over the columns of x, zero padded by left and right
+    # columns instead of the conv's own width padding, so every output column is kept
+    conv = block[0];
+    x = nn.functional.pad(x, (left, right, 0, 0));
+    out = nn.functional.conv2d(x, conv.weight, conv.bias, conv.stride, (conv.padding[0], 0));
+
+    return block[1:](out);
+
+class QuantTrunk(nn.Module):
+
+    # Conv trunk between quant/dequant stubs, for static int8 quantization
+    def __init__(self, trunk):
+        super(QuantTrunk, self).__init__();
+
+        self.quant   = torch.quantization.QuantStub();
+        self.trunk   = trunk;
+        self.dequant = torch.quantization.DeQuantStub();
+
+    def forward(self, x):
+
+        return self.dequant(self.trunk(self.quant(x)));
+
+def quantize(model, calibration=None, static=True, backend='fbgemm'):
+
+    # int8 CPU copy of S. BatchNorm is folded first, the Linear heads are quantized
+    # dynamically, and with static=True the conv trunks are quantized statically
+    # using activation ranges observed on calibration, a list of
+    # (lip clip N x 3 x T x H x W, MFCC windows N x 1 x 13 x 20) batches.
+    # A trunk whose quantized ops the backend does not support stays in fp32.
+    qmodel = fuse_bn(model);
+
+    qmodel.netfcaud = torch.quantization.quantize_dynamic(qmodel.netfcaud, {nn.Linear}, dtype=torch.qint8);
+    qmodel.netfclip = torch.quantization.quantize_dynamic(qmodel.netfclip, {nn.Linear}, dtype=torch.qint8);
+
+    if not static or not calibration:
+        return qmodel;
+
+    torch.backends.quantized.engine = backend;
+
+    fp32 = {};
+    for name in ['netcnnlip', 'netcnnaud']:
+        seq = getattr(qmodel, name);
+        fp32[name] = copy.deepcopy(seq);
+
+        # After fuse_bn every conv is followed by Identity, ReLU
+        pairs = [ [str(i), str(i+2)] for i in range(len(seq)-2) if isinstance(seq[i], (nn.Conv2d, nn.Conv3d)) and isinstance(seq[i+2], nn.ReLU) ];
+        torch.quantization.fuse_modules(seq, pairs, inplace=True);
+
+        trunk = QuantTrunk(seq);
+        trunk.qconfig = torch.quantization.get_default_qconfig(backend);
+        torch.quantization.prepare(trunk, inplace=True);
+        setattr(qmodel, name, trunk);
+
+    with torch.no_grad():
+        for lip, aud in calibration:
+            qmodel.netcnnlip(lip);
+            qmodel.netcnnaud(aud);
+
+    for name, inputs in [('netcnnlip', calibration[0][0]), ('netcnnaud', calibration[0][1])]:
+        trunk = torch.quantization.convert(getattr(qmodel, name), inplace=False);
+        try:
+            with torch.no_grad():
+                trunk(inputs);
+            setattr(qmodel, name, trunk);
+        except (RuntimeError, NotImplementedError) as e:
+            print("WARNING: %s kept in fp32, static quantization not supported (%s)"%(name, str(e).splitlines()[0]));
+            setattr(qmodel, name, fp32[name]);
+
+    return qmodel.eval();
+
 class S(nn.Module):
     def __init__(self, num_layers_in_fc_layers = 1024):
         super(S, self).__init__();
@@ -101,6 +210,67 @@ class S(nn.Module):
 
         return out;
 
+    # netcnnaud zero-pads every 20-column MFCC window, so the columns near each
+    # window edge differ from the same columns computed over the whole strip. The
+    # inner columns do not: 18 after the first conv, 16 after the second, and the
+    # (3,3)/(1,2) pool maps the 4-column window stride onto 2 pooled columns, so
+    # 7, 5 and 3 of the 9 pooled columns after the pool and the next two convs.
+    # Each conv block is run once over the strip for the inner columns, and only
+    # the edge columns (the halo) are recomputed per window from the window's
+    # previous layer. The fifth conv has a single inner column, fewer than the 2
+    # strip columns per window it would cost, so it runs per window.
+
+    def forward_aud_seq(self, x, nwin, width=20, stride=4):
+
+        # x: 1 x 1 x 13 x L strip holding nwin windows of width columns every stride columns
+        x = x[:,:,:,:stride*(nwin-1)+width];
+
+        windows = aud_windows(x, nwin, width, stride); # N x 1 x 13 x 20
+
+        if not isinstance(self.netcnnaud, nn.Sequential):
+            # Wrapped trunk (e.g. quantized), the layers cannot be run separately
+            return self.forward_aud(windows);
+
+        trunk = self.netcnnaud;
+
+        mid   = windows; # per window
+        strip = x;       # shared, window w starts at column step*w
+        lo, hi, step = 0, width, stride # columns lo..hi-1 of every window equal the strip
+
+        # Conv blocks (conv, bn, relu) and pools up to the last pool
+        for block in [trunk[0:4], trunk[4:7], trunk[7:8], trunk[8:11], trunk[11:14], trunk[14:17]]:
+            layer = block[0];
+
+            if strip is None:
+                mid = block(mid);
+
+            elif isinstance(layer, nn.MaxPool2d):
+                # Pooled column p covers columns stride*p to stride*p+kernel-1
+                kernel, pstride = layer.kernel_size[1], layer.stride[1];
+                mid = block(mid);
+                strip = block(strip) if step % pstride == 0 else None;
+                lo, hi, step = -(-lo//pstride), (hi-kernel)//pstride+1, step//pstride;
+
+            else:
+                r = layer.padding[1];
+                if hi-lo-2*r <= step:
+                    # Recomputing the whole window is cheaper than the strip columns
+                    mid = block(mid);
+                    strip = None;
+                    continue
+
+                lo, hi = lo+r, hi-r;
+                strip = block(strip);
+                left  = conv_cols(block, mid[:,:,:,:lo+r], r, 0);
+                right = conv_cols(block, mid[:,:,:,hi-r:], 0, r);
+                mid   = torch.cat((left, strip_cols(strip, nwin, lo, hi, step), right), 3);
+
+        mid = trunk[17:](mid); # N x ch x 1 x 1
+        mid = mid.view((mid.size()[0], -1)); # N x ch
+        out = self.netfcaud(mid);
+
+        return out;
+
     def forward_lip(self, x):
 
         mid = self.netcnnlip(x); 
@@ -114,4 +284,136 @@ class S(nn.Module):
         mid = self.netcnnlip(x);
         out = mid.view((mid.size()[0], -1)); # N x (ch x 24)
 
-        return out;
\ No newline at end of file
+        return out;
+
+    # Only the first Conv3d of netcnnlip has a temporal extent (5 frames), every
+    # later layer has temporal kernel 1. A clip of T frames therefore goes through
+    # the trunk in one pass and gives the T-4 outputs of its 5-frame windows,
+    # without copying each frame into five overlapping windows.
+
+    def forward_lip_seq(self, x):
+
+        out = self.forward_lipfeat_seq(x); # N(T-4) x ch
+        out = self.netfclip(out);
+
+        return out;
+
+    def forward_lipfeat_seq(self, x):
+
+        mid = self.netcnnlip(x); # N x ch x (T-4) x 1 x 1
+        mid = mid.transpose(1,2).contiguous(); # N x (T-4) x ch x 1 x 1
+        out = mid.view((mid.size()[0]*mid.size()[1], -1)); # N(T-4) x ch
+
+        return out;
+
+# ==================== EXPORTED GRAPHS ====================
+
+# Methods of S the scorers call, and the example inputs they are traced with
+EXPORTED = ['forward_lip_seq', 'forward_lipfeat_seq', 'forward_aud'];
+
+def example_inputs():
+
+    return {'forward_lip_seq': torch.rand(1, 3, 9, 224, 224) * 255,
+            'forward_lipfeat_seq': torch.rand(1, 3, 9, 224, 224) * 255,
+            'forward_aud': torch.randn(5, 1, 13, 20)};
+
+class Method(nn.Module):
+
+    # Exposes one method of S as forward, for ONNX export
+    def __init__(self, model, name):
+        super(Method, self).__init__();
+
+        self.model = model;
+        self.name = name;
+
+    def forward(self, x):
+
+        return getattr(self.model, self.name)(x);
+
+def export(model, prefix, onnx=False, info=None):
+
+    # Writes prefix.ts (TorchScript, all EXPORTED methods traced) and, with onnx=True,
+    # prefix.<method>.onnx for onnxruntime, with dynamic batch and time axes. info,
+    # e.g. the digest of the weights and whether BatchNorm was fused, is saved to
+    # prefix.export.json for load_export_info.
+    model = model.eval();
+    inputs = example_inputs();
+
+    with torch.no_grad():
+        traced = torch.jit.trace_module(model, inputs);
+    traced.save(prefix + '.ts');
+    print("%s saved."%(prefix + '.ts'));
+
+    if info is not None:
+        with open(prefix + '.export.json.tmp', 'w') as f:
+            json.dump(info, f);
+        os.replace(prefix + '.export.json.tmp', prefix + '.export.json');
+
+    if not onnx:
+        return;
+
+    for name in EXPORTED:
+        dynamic = {'input': {0: 'batch', 2: 'time'}, 'output': {0: 'windows'}} if name != 'forward_aud' else {'input': {0: 'windows'}, 'output': {0: 'windows'}};
+        torch.onnx.export(Method(model, name), inputs[name], prefix + '.%s.onnx'%name, input_names=['input'], output_names=['output'], dynamic_axes=dynamic, opset_version=11);
+        print("%s saved."%(prefix + '.%s.onnx'%name));
+
+class CompiledS(nn.Module):
+
+    # Inference API of S on top of exported graphs: a TorchScript module, or
+    # a dict of onnxruntime sessions keyed by method name
+    def __init__(self, traced=None, sessions=None):
+        super(CompiledS, self).__init__();
+
+        self.traced = traced;
+        self.sessions = sessions;
+
+    def run(self, name, x):
+
+        if self.sessions is not None:
+            return torch.from_numpy(self.sessions[name].run(None, {'input': x.contiguous().numpy()})[0]);
+
+        return getattr(self.traced, name)(x);
+
+    def forward_lip_seq(self, x):
+
+        return self.run('forward_lip_seq', x);
+
+    def forward_lipfeat_seq(self, x):
+
+        return self.run('forward_lipfeat_seq', x);
+
+    def forward_aud(self, x):
+
+        return self.run('forward_aud', x);
+
+    def forward_aud_seq(self, x, nwin, width=20, stride=4):
+
+        return self.forward_aud(aud_windows(x, nwin, width, stride));
+
+def load_export_info(prefix):
+
+    # info saved by export, or None for graphs exported without it
+    if not os.path.exists(prefix + '.export.json'):
+        return None;
+
+    with open(prefix + '.export.json') as f:
+        return json.load(f);
+
+def load_compiled(prefix, engine='torch'):
+
+    # CompiledS from the graphs written by export, or None when there are none
+    if engine == 'onnx':
+        try:
+            import onnxruntime
+        except ImportError:
+            print("WARNING: onnxruntime is not installed, using TorchScript.");
+            engine = 'torch';
+
+    if engine == 'onnx' and all(os.path.exists(prefix + '.%s.onnx'%name) for name in EXPORTED):
+        sessions = { name: onnxruntime.InferenceSession(prefix + '.%s.onnx'%name, providers=['CPUExecutionProvider']) for name in EXPORTED };
+        return CompiledS(sessions=sessions);
+
+    if os.path.exists(prefix + '.ts'):
+        return CompiledS(traced=torch.jit.load(prefix + '.ts', map_location='cpu'));
+
+    return None;
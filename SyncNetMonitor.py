@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Incremental sync scoring for live input. Frames and PCM are pushed as they
+# arrive, the embeddings of the most recent windows are kept in a ring buffer,
+# and the offset is re-estimated after every embedded batch.
+
+import math
+import numpy
+import torch
+
+from SyncNetInstance import calc_pdist, inference_mode
+from SyncNetMFCC import mfcc_batch, WINLEN, WINSTEP
+
+class EmbeddingRing():
+
+    # The last capacity rows of a growing [T, D] sequence. Rows are appended to a
+    # buffer of 2*capacity and moved to the front when it is full, so appends are
+    # amortised O(1) and get() is a view.
+
+    def __init__(self, capacity):
+
+        self.capacity = capacity
+        self.buf  = None
+        self.size = 0
+
+    def extend(self, rows):
+
+        if self.buf is None:
+            self.buf = torch.empty(2*self.capacity, rows.size(1), dtype=rows.dtype)
+
+        rows = rows[-self.capacity:]
+
+        if self.size + len(rows) > len(self.buf):
+            keep = self.capacity - len(rows)
+            self.buf[:keep] = self.buf[self.size-keep:self.size].clone()
+            self.size = keep
+
+        self.buf[self.size:self.size+len(rows)] = rows
+        self.size += len(rows)
+
+    def get(self):
+
+        return self.buf[max(self.size-self.capacity,0):self.size]
+
+    def __len__(self):
+
+        return min(self.size, self.capacity)
+
+class SyncNetMonitor():
+
+    # push() takes BGR uint8 face crops [H,W,3] at 25 fps and mono int16 PCM at
+    # sample_rate in any chunking. Windows are embedded once batch_size of them
+    # have both their 5 frames and their 20 MFCC columns, which bounds the latency
+    # to batch_size frames plus one forward pass. The estimate is over the last
+    # window embeddings, plus a running estimate from the mean distance per lag
+    # decayed by decay per batch. The MFCC of each batch starts at its first
+    # window, so it can differ from evaluate in the pre-emphasis of one sample.
+
+    def __init__(self, model, vshift=15, window=100, batch_size=5, decay=0.9, sample_rate=16000):
+
+        self.model      = model
+        self.vshift     = vshift
+        self.batch_size = batch_size
+        self.decay      = decay
+        self.sample_rate = sample_rate
+
+        # Samples per video frame (4 MFCC steps) and per 20-column window
+        step = int(math.floor(WINSTEP*sample_rate + 0.5))
+        self.hop  = 4*step
+        self.span = 19*step + int(math.floor(WINLEN*sample_rate + 0.5))
+
+        self.frames  = []                               # pending frames, from frame self.nwin
+        self.audio   = numpy.zeros(0, dtype=numpy.int16) # pending samples, from sample self.nwin*self.hop
+        self.nwin    = 0
+
+        self.im_ring = EmbeddingRing(window)
+        self.cc_ring = EmbeddingRing(window)
+
+        self.mdist_ema = None
+        self.estimate  = None
+
+    def push(self, frames=(), audio=None):
+
+        # Returns (offset, conf, ema_offset, ema_conf), or None before the first
+        # vshift+1 windows are embedded
+        self.frames.extend(frames)
+        if audio is not None and len(audio) > 0:
+            self.audio = numpy.concatenate((self.audio, numpy.asarray(audio, dtype=numpy.int16)))
+
+        updated = False
+        while self.available() >= self.batch_size:
+            self.embed(self.batch_size)
+            updated = True
+
+        if updated:
+            self.update()
+
+        return self.estimate
+
+    def flush(self):
+
+        # Embed the windows of a final partial batch, e.g. at the end of the input
+        if self.available() > 0:
+            self.embed(self.available())
+            self.update()
+
+        return self.estimate
+
+    def available(self):
+
+        return min(len(self.frames)-4, (len(self.audio)-self.span)//self.hop + 1)
+
+    def embed(self, nwin):
+
+        im = numpy.stack(self.frames[:nwin+4], 0)
+        imtv = torch.from_numpy(numpy.ascontiguousarray(numpy.transpose(im,(3,0,1,2))[None])).float()
+
+        mfcc = mfcc_batch([self.audio[:(nwin-1)*self.hop+self.span]], self.sample_rate)[0]
+        cct = torch.from_numpy(mfcc[None,None])
+
+        with inference_mode():
+            self.im_ring.extend(self.model.forward_lip_seq(imtv).cpu())
+            self.cc_ring.extend(self.model.forward_aud_seq(cct, nwin).cpu())
+
+        del self.frames[:nwin]
+        self.audio = self.audio[nwin*self.hop:]
+        self.nwin += nwin
+
+    def update(self):
+
+        if len(self.im_ring) <= self.vshift:
+            return
+
+        dists = calc_pdist(self.im_ring.get(), self.cc_ring.get(), vshift=self.vshift)
+        mdist = torch.mean(dists,0)
+
+        if self.mdist_ema is None:
+            self.mdist_ema = mdist
+        else:
+            self.mdist_ema = self.decay*self.mdist_ema + (1-self.decay)*mdist
+
+        self.estimate = self.offset_conf(mdist) + self.offset_conf(self.mdist_ema)
+
+    def offset_conf(self, mdist):
+
+        minval, minidx = torch.min(mdist,0)
+
+        return self.vshift-int(minidx), float(torch.median(mdist)-minval)
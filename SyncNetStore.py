@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# On-disk store of per-track lip/audio embeddings, keyed by the content of the
+# crop file, the model weights and the decode path, with size-bounded LRU eviction
+
+import os
+import glob
+import hashlib
+import numpy
+import torch
+
+def file_digest(path, chunk_size=1<<20):
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+class EmbeddingStore():
+
+    def __init__(self, path, max_bytes):
+
+        self.path = path
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, videofile, model_key, frames='disk'):
+
+        # frames is 'disk' for frames round-tripped through JPEG files, 'raw' for
+        # frames decoded straight from the video, which embed differently
+        return hashlib.sha1(('%s:%s:%s' % (file_digest(videofile), model_key, frames)).encode()).hexdigest()
+
+    def files(self, key):
+
+        return os.path.join(self.path, key+'.lip.npy'), os.path.join(self.path, key+'.aud.npy')
+
+    def get(self, key):
+
+        # Memory-mapped (copy-on-write) embeddings, or None on a miss
+        lipfile, audfile = self.files(key)
+        if not (os.path.exists(lipfile) and os.path.exists(audfile)):
+            return None
+
+        # Touch both files so eviction sees them as recently used
+        os.utime(lipfile)
+        os.utime(audfile)
+
+        im_feat = torch.from_numpy(numpy.load(lipfile, mmap_mode='c'))
+        cc_feat = torch.from_numpy(numpy.load(audfile, mmap_mode='c'))
+
+        return im_feat, cc_feat
+
+    def put(self, key, im_feat, cc_feat):
+
+        # Written under a temporary name and renamed, so readers never see partial files
+        for fname, feat in zip(self.files(key), [im_feat, cc_feat]):
+            tmpname = fname[:-len('.npy')] + '.tmp.npy'
+            numpy.save(tmpname, feat.numpy().astype(numpy.float32))
+            os.replace(tmpname, fname)
+
+        self.evict()
+
+    def evict(self):
+
+        # Drop least recently used entries until the store fits in max_bytes
+        entries = {}
+        for fname in glob.glob(os.path.join(self.path, '*.lip.npy')) + glob.glob(os.path.join(self.path, '*.aud.npy')):
+            key = os.path.basename(fname).split('.')[0]
+            stat = os.stat(fname)
+            size, mtime = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(mtime, stat.st_mtime))
+
+        total = sum(size for size, _ in entries.values())
+
+        for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            for fname in self.files(key):
+                if os.path.exists(fname):
+                    os.remove(fname)
+            total -= size
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, time, resource, argparse
+
+import numpy
+import torch
+
+from SyncNetModel import *
+from SyncNetMonitor import SyncNetMonitor
+from detectors import S3FD
+from detectors.s3fd import PATH_WEIGHT
+from detectors.s3fd.box_utils import Detect, PriorBox, decode, nms, nms_, nms_boxes
+
+# ==================== PARSE ARGUMENT ====================
+
+parser = argparse.ArgumentParser(description = "SyncNet benchmarks");
+parser.add_argument('--initial_model', type=str, default="", help='Optional weights, random initialisation otherwise');
+parser.add_argument('--batch_size', type=int, default='20', help='');
+parser.add_argument('--seconds', type=float, default='60', help='Clip length in seconds (25 fps video, 100 MFCC columns per second)');
+parser.add_argument('--bench', type=str, default='aud', help='Comma separated list of benchmarks: aud, stream, input, facedet, nms');
+parser.add_argument('--repeats', type=int, default='1', help='');
+opt = parser.parse_args();
+
+# ==================== HELPERS ====================
+
+def timeit(fn, repeats):
+
+    best = None
+    for _ in range(repeats):
+        tS = time.time()
+        fn()
+        elapsed = time.time()-tS
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def report(name, baseline, candidate):
+
+    print('%-28s baseline %8.3f sec, candidate %8.3f sec, speedup %.2fx' % (name, baseline, candidate, baseline/candidate))
+
+def peak_rss(fn):
+
+    # Peak RSS in MB of a forked child running fn, so each path starts from the same footprint
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        fn()
+        os.write(wfd, str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss).encode())
+        os._exit(0)
+
+    os.close(wfd)
+    maxrss = int(os.read(rfd, 64))
+    os.close(rfd)
+    os.waitpid(pid, 0)
+
+    return maxrss/1024.
+
+# ==================== BENCHMARKS ====================
+
+def bench_aud(model):
+
+    # forward_aud on 20-column windows vs forward_aud_seq over the shared strip
+    nwin = int(opt.seconds*25)-5
+    strip = torch.randn(1, 1, 13, 4*(nwin-1)+20)
+
+    def windowed():
+        for i in range(0, nwin, opt.batch_size):
+            batch = [ strip[:,:,:,v*4:v*4+20] for v in range(i, min(nwin, i+opt.batch_size)) ]
+            model.forward_aud(torch.cat(batch,0))
+
+    def shared():
+        for i in range(0, nwin, opt.batch_size):
+            n = min(nwin, i+opt.batch_size)-i
+            model.forward_aud_seq(strip[:,:,:,i*4:(i+n-1)*4+20], n)
+
+    with torch.no_grad():
+        report('audio %d windows' % nwin, timeit(windowed, opt.repeats), timeit(shared, opt.repeats))
+
+def bench_stream(model):
+
+    # SyncNetMonitor fed one frame and 40 ms of PCM at a time, as from a live source.
+    # Latency is the time push() blocks, the update interval is batch_size frames.
+    monitor = SyncNetMonitor(model, batch_size=opt.batch_size)
+
+    frame = numpy.random.randint(0, 256, (224,224,3), dtype=numpy.uint8)
+    audio = (numpy.random.randn(640)*3000).astype(numpy.int16)
+
+    latency = []
+    for _ in range(int(opt.seconds*25)):
+        tS = time.time()
+        monitor.push([frame], audio)
+        latency.append(time.time()-tS)
+
+    latency = numpy.array(latency)*1000
+    updates = latency[opt.batch_size+4::opt.batch_size]
+
+    print('%-28s p50 %7.1f ms, p95 %7.1f ms, max %7.1f ms per update (%d updates, %.1f ms per frame)' %
+          ('stream batch %d' % opt.batch_size, numpy.percentile(updates,50), numpy.percentile(updates,95), updates.max(), len(updates), latency.mean()))
+
+def bench_input(model):
+
+    # Preprocessing of decoded frames up to the float batches the lip tower takes:
+    # a float64 then float32 copy of the whole clip vs a uint8 [3,T,H,W] copy
+    # converted to float per batch. No forward passes, times are per frame.
+    nframes = int(opt.seconds*25)
+    frames = numpy.random.randint(0, 256, (nframes,224,224,3), dtype=numpy.uint8)
+
+    def batches(imtv):
+        for i in range(0, nframes-4, opt.batch_size):
+            imtv[:,:,i:min(nframes-4,i+opt.batch_size)+4].float()
+
+    def float_clip():
+        im = numpy.transpose(numpy.expand_dims(frames,axis=0),(0,4,1,2,3))
+        batches(torch.from_numpy(im.astype(float)).float())
+
+    def uint8_clip():
+        batches(torch.from_numpy(numpy.ascontiguousarray(numpy.transpose(frames,(3,0,1,2))))[None])
+
+    baseline, candidate = timeit(float_clip, opt.repeats), timeit(uint8_clip, opt.repeats)
+
+    report('input %d frames' % nframes, baseline, candidate)
+    print('%-28s baseline %8.3f ms, candidate %8.3f ms per frame' % ('', 1000*baseline/nframes, 1000*candidate/nframes))
+    print('%-28s baseline %8.0f MB, candidate %8.0f MB peak RSS' % ('', peak_rss(float_clip), peak_rss(uint8_clip)))
+
+def bench_facedet(model):
+
+    # S3FD on 720p frames at the pipeline's 0.25 detection scale, one frame per
+    # forward vs batch_size frames per forward. Reported in frames per second.
+    DET = S3FD(device='cpu', weights=PATH_WEIGHT if os.path.exists(PATH_WEIGHT) else None)
+
+    frames = [ numpy.random.randint(0, 256, (720,1280,3), dtype=numpy.uint8) for _ in range(4*opt.batch_size) ]
+
+    def single():
+        for frame in frames:
+            DET.detect_faces(frame, conf_th=0.9, scales=[0.25])
+
+    def batched():
+        for i in range(0, len(frames), opt.batch_size):
+            DET.detect_faces_batch(frames[i:i+opt.batch_size], conf_th=0.9, scales=[0.25])
+
+    baseline, candidate = timeit(single, opt.repeats), timeit(batched, opt.repeats)
+
+    report('facedet %d frames' % len(frames), baseline, candidate)
+    print('%-28s baseline %8.1f fps, candidate %8.1f fps' % ('', len(frames)/baseline, len(frames)/candidate))
+
+def bench_nms(model):
+
+    # S3FD postprocessing of batch_size crowded 320x180 frames, thousands of priors
+    # over conf_thresh and hundreds over conf_th: the per-box loops (Detect with nms,
+    # while loop extraction, nms_) vs batched_nms, mask extraction and nms_boxes,
+    # both at Detect's conf_thresh, then vectorized with conf_th pushed into Detect
+    size = (180, 320)
+    priors = PriorBox(size, [[-(-size[0]//step), -(-size[1]//step)] for step in [4, 8, 16, 32, 64, 128]]).forward()
+
+    torch.manual_seed(0)
+    loc  = torch.randn(opt.batch_size, len(priors), 4)*0.5
+    conf = torch.softmax(torch.randn(opt.batch_size, len(priors), 2)*3, -1)
+
+    detect = Detect()
+    scale = torch.Tensor([size[1], size[0], size[1], size[0]])
+
+    def loops():
+        boxes = decode(loc.view(-1, 4), priors.repeat(opt.batch_size, 1), detect.variance).view(opt.batch_size, -1, 4)
+        for b in range(opt.batch_size):
+            c_mask = conf[b, :, 1].gt(detect.conf_thresh)
+            scores = conf[b, :, 1][c_mask]
+            boxes_ = boxes[b][c_mask]
+            ids, count = nms(boxes_, scores, detect.nms_thresh, detect.nms_top_k)
+            count = min(count, detect.top_k)
+            dets = torch.cat((scores[ids[:count]].unsqueeze(1), boxes_[ids[:count]]), 1)
+
+            bboxes = numpy.empty(shape=(0, 5))
+            j = 0
+            while j < count and dets[j, 0] > 0.9:
+                pt = (dets[j, 1:] * scale).numpy()
+                bboxes = numpy.vstack((bboxes, (pt[0], pt[1], pt[2], pt[3], dets[j, 0])))
+                j += 1
+            bboxes[nms_(bboxes, 0.1)]
+
+    def vectorized(conf_thresh=None):
+        detections = detect.forward(loc, conf, priors, conf_thresh=conf_thresh)
+        for b in range(opt.batch_size):
+            dets = detections[b][detections[b, :, :, 0] > 0.9]
+            bboxes = torch.cat((dets[:, 1:] * scale, dets[:, :1]), 1).numpy().astype(numpy.float64)
+            bboxes[nms_boxes(bboxes, 0.1)]
+
+    with torch.no_grad():
+        baseline = timeit(loops, opt.repeats)
+        candidate = timeit(vectorized, opt.repeats)
+        pushdown = timeit(lambda: vectorized(conf_thresh=0.9), opt.repeats)
+
+    report('nms %d frames' % opt.batch_size, baseline, candidate)
+    report('nms %d frames, pushdown' % opt.batch_size, candidate, pushdown)
+
+BENCHMARKS = {'aud': bench_aud, 'stream': bench_stream, 'input': bench_input, 'facedet': bench_facedet, 'nms': bench_nms}
+
+# ==================== RUN ====================
+
+model = S(num_layers_in_fc_layers = 1024);
+
+if opt.initial_model != '':
+    model.load_state_dict(torch.load(opt.initial_model, map_location=lambda storage, loc: storage));
+    print("Model %s loaded."%opt.initial_model);
+
+model.eval();
+
+for name in opt.bench.split(','):
+    BENCHMARKS[name](model)
@@ -13,9 +13,11 @@ parser = argparse.ArgumentParser(description = "SyncNet");
 parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
 parser.add_argument('--batch_size', type=int, default='20', help='');
 parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--fuse_bn', action='store_true', help='Fold BatchNorm layers into the preceding conv/linear layers at load time');
+parser.add_argument('--engine', type=str, default='torch', choices=['torch','onnx'], help='Runtime for graphs exported by export_model.py, used when they are present');
 parser.add_argument('--videofile', type=str, default="data/example.avi", help='');
 parser.add_argument('--tmp_dir', type=str, default="data", help='');
-parser.add_argument('--save_as', type=str, default="data/features.pt", help='');
+parser.add_argument('--save_as', type=str, default="data/features.pt", help='Output file; a .npy file is written batch by batch and resumed if interrupted');
 
 opt = parser.parse_args();
 
@@ -24,9 +26,12 @@ opt = parser.parse_args();
 
 s = SyncNetInstance();
 
-s.loadParameters(opt.initial_model);
+s.loadParameters(opt.initial_model, fuse=opt.fuse_bn, engine=opt.engine);
 print("Model %s loaded."%opt.initial_model);
 
-feats = s.extract_feature(opt, videofile=opt.videofile)
+if opt.save_as.endswith('.npy'):
+    s.extract_feature_to_file(opt, videofile=opt.videofile, outfile=opt.save_as)
+else:
+    feats = s.extract_feature(opt, videofile=opt.videofile)
 
-torch.save(feats, opt.save_as)
+    torch.save(feats, opt.save_as)
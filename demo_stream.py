@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import time, argparse, subprocess, os, threading
+
+from SyncNetInstance import *
+from SyncNetMonitor import SyncNetMonitor
+
+# ==================== LOAD PARAMS ====================
+
+
+parser = argparse.ArgumentParser(description = "SyncNet live monitor");
+
+parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
+parser.add_argument('--batch_size', type=int, default='5', help='Windows per forward pass, the update interval in frames');
+parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--window', type=int, default='100', help='Number of most recent windows (frames) the offset is estimated over');
+parser.add_argument('--decay', type=float, default='0.9', help='Decay per update of the running estimate');
+parser.add_argument('--fuse_bn', action='store_true', help='Fold BatchNorm layers into the preceding conv/linear layers at load time');
+parser.add_argument('--engine', type=str, default='torch', choices=['torch','onnx'], help='Runtime for graphs exported by export_model.py, used when they are present');
+parser.add_argument('--source', type=str, default="data/example.avi", help='Face track file, FIFO or stream URL (e.g. udp://127.0.0.1:1234) readable by ffmpeg');
+parser.add_argument('--follow', action='store_true', help='Keep reading a file that is still being written');
+parser.add_argument('--realtime', action='store_true', help='Read the source at its native frame rate, to use a finished file as a live stand-in');
+
+opt = parser.parse_args();
+
+# ==================== LIVE DECODE ====================
+
+def open_live_pipe(source):
+
+    # One ffmpeg process for both streams, so FIFOs and sockets are only read once:
+    # 224x224 BGR frames at 25 fps on stdout, 16 kHz mono PCM on a second pipe
+    rfd, wfd = os.pipe()
+
+    command = ['ffmpeg', '-loglevel', 'error']
+    if opt.realtime:
+        command += ['-re']
+    if opt.follow:
+        command += ['-follow', '1']
+    command += ['-i', source,
+                '-map', '0:v:0', '-vf', 'scale=224:224', '-r', '25', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1',
+                '-map', '0:a:0', '-ac', '1', '-ar', '16000', '-f', 's16le', '-acodec', 'pcm_s16le', 'pipe:%d' % wfd]
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, pass_fds=(wfd,))
+    os.close(wfd)
+
+    return proc, os.fdopen(rfd, 'rb')
+
+def read_audio(stream, chunks, lock):
+
+    # Drains the audio pipe so ffmpeg never blocks on it while we read frames
+    while True:
+        data = stream.read1(1280)
+        if not data:
+            break
+        with lock:
+            chunks.append(data)
+
+# ==================== RUN MONITOR ====================
+
+s = SyncNetInstance();
+
+s.loadParameters(opt.initial_model, fuse=opt.fuse_bn, engine=opt.engine);
+print("Model %s loaded."%opt.initial_model);
+
+model = s.__S__
+if hasattr(model, 'eval'):
+    model.eval()
+
+monitor = SyncNetMonitor(model, vshift=opt.vshift, window=opt.window, batch_size=opt.batch_size, decay=opt.decay)
+
+proc, audio_stream = open_live_pipe(opt.source)
+
+chunks = []
+lock = threading.Lock()
+reader = threading.Thread(target=read_audio, args=(audio_stream, chunks, lock), daemon=True)
+reader.start()
+
+def take_audio():
+
+    # PCM received so far, an odd trailing byte stays queued
+    with lock:
+        data = b''.join(chunks)
+        del chunks[:]
+        if len(data) % 2:
+            chunks.append(data[-1:])
+            data = data[:-1]
+
+    return numpy.frombuffer(data, dtype=numpy.int16)
+
+print('%8s %8s %8s %8s %10s %8s' % ('time', 'frames', 'offset', 'conf', 'ema_offset', 'ema_conf'))
+
+tS = time.time()
+nframes = 0
+last = None
+while True:
+    data = proc.stdout.read(224*224*3)
+    eof = len(data) < 224*224*3
+
+    if eof:
+        close_pipe(proc)
+        reader.join()
+        monitor.push((), take_audio())
+        estimate = monitor.flush()
+    else:
+        nframes += 1
+        estimate = monitor.push([numpy.frombuffer(data, dtype=numpy.uint8).reshape(224,224,3)], take_audio())
+
+    if estimate is not None and monitor.nwin != last:
+        last = monitor.nwin
+        print('%8.2f %8d %+8d %8.3f %+10d %8.3f' % ((time.time()-tS, nframes) + estimate))
+
+    if eof:
+        break
+
+audio_stream.close()
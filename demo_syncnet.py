@@ -13,6 +13,13 @@ parser = argparse.ArgumentParser(description = "SyncNet");
 parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
 parser.add_argument('--batch_size', type=int, default='20', help='');
 parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--search', type=str, default='full', choices=['full','adaptive','fft'], help='Offset search over +-vshift: exhaustive, coarse-to-fine from +-vshift_init, or FFT cross-correlation for large vshift');
+parser.add_argument('--vshift_init', type=int, default='3', help='Initial half-width of the adaptive search');
+parser.add_argument('--fuse_bn', action='store_true', help='Fold BatchNorm layers into the preceding conv/linear layers at load time');
+parser.add_argument('--engine', type=str, default='torch', choices=['torch','onnx'], help='Runtime for graphs exported by export_model.py, used when they are present');
+parser.add_argument('--decode', type=str, default='disk', choices=['disk','pipe'], help='Decode via JPEG/WAV files in tmp_dir, or stream raw frames and PCM from an ffmpeg pipe');
+parser.add_argument('--pipeline', action='store_true', help='Prepare batches in a background thread and run the lip and audio towers concurrently');
+parser.add_argument('--stream', action='store_true', help='Decode from an ffmpeg pipe in rolling windows so memory does not grow with track length');
 parser.add_argument('--videofile', type=str, default="data/example.avi", help='');
 parser.add_argument('--tmp_dir', type=str, default="data/work/pytmp", help='');
 parser.add_argument('--reference', type=str, default="demo", help='');
@@ -24,7 +31,7 @@ opt = parser.parse_args();
 
 s = SyncNetInstance();
 
-s.loadParameters(opt.initial_model);
+s.loadParameters(opt.initial_model, fuse=opt.fuse_bn, engine=opt.engine);
 print("Model %s loaded."%opt.initial_model);
 
 s.evaluate(opt, videofile=opt.videofile)
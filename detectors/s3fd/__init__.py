@@ -1,61 +1,111 @@
 import time
+import contextlib
 import numpy as np
 import cv2
 import torch
 from torchvision import transforms
 from .nets import S3FDNet
-from .box_utils import nms_
+from .box_utils import nms_boxes
 
 PATH_WEIGHT = './detectors/s3fd/weights/sfd_face.pth'
 img_mean = np.array([104., 117., 123.])[:, np.newaxis, np.newaxis].astype('float32')
+# The mean above is in BGR order; frames come in and go to the network as RGB
+img_mean_rgb = img_mean[[2, 1, 0]]
+NULL_STAGE = contextlib.nullcontext()
 
 
 class S3FD():
 
-    def __init__(self, device='cpu'):
+    def __init__(self, device='cpu', profiler=None, weights=PATH_WEIGHT, fold_mean=False):
 
         tstamp = time.time()
         self.device = device
+        self.profiler = profiler
+        self.fold_mean = fold_mean
+        self.buffer = None
 
         print('[S3FD] loading with', self.device)
         self.net = S3FDNet(device=self.device).to(self.device)
-        state_dict = torch.load(PATH_WEIGHT, map_location=self.device)
-        self.net.load_state_dict(state_dict)
+        if weights is not None:
+            state_dict = torch.load(weights, map_location=self.device)
+            self.net.load_state_dict(state_dict)
+        if fold_mean:
+            self.net.fold_input_mean(img_mean_rgb.reshape(3))
         self.net.eval()
         print('[S3FD] finished loading (%.4f sec)' % (time.time() - tstamp))
+
+    def preprocess(self, images, s, bgr=False):
+
+        # Resizes each frame and writes it minus the mean, as float32 CHW, straight
+        # into a reused NCHW buffer. This is the same arithmetic as the float32
+        # conversion and mean subtraction on the swapped axes, with one write per
+        # pixel. With fold_mean, the raw pixels go into the buffer instead and the
+        # first convolution subtracts the mean; its border then holds the mean, the
+        # raw-pixel equivalent of zero padding. BGR frames are read through a
+        # reversed channel view, resizing treats the channels independently.
+        pad = 1 if self.fold_mean else 0
+
+        for b, image in enumerate(images):
+            scaled_img = cv2.resize(image, dsize=(0, 0), fx=s, fy=s, interpolation=cv2.INTER_LINEAR)
+            sh, sw = scaled_img.shape[:2]
+            chw = scaled_img[:, :, ::-1].transpose(2, 0, 1) if bgr else scaled_img.transpose(2, 0, 1)
+
+            if b == 0:
+                shape = (3, sh + 2 * pad, sw + 2 * pad)
+                if self.buffer is None or self.buffer.shape[1:] != shape or len(self.buffer) < len(images):
+                    self.buffer = np.empty((len(images),) + shape, dtype=np.float32)
+                    if pad:
+                        self.buffer[:] = img_mean_rgb
+
+            dst = self.buffer[b, :, pad:pad + sh, pad:pad + sw]
+            if self.fold_mean:
+                dst[...] = chw
+            else:
+                np.subtract(chw, img_mean_rgb, out=dst)
+
+        return torch.from_numpy(self.buffer[:len(images)]).to(self.device)
+
+    def stage(self, name, count=1):
+
+        # Timer of the optional profiler (SyncNetProfiler.Profiler), a no-op without one
+        return self.profiler.stage(name, count) if self.profiler is not None else NULL_STAGE
     
-    def detect_faces(self, image, conf_th=0.8, scales=[1]):
+    def detect_faces(self, image, conf_th=0.8, scales=[1], top_k=750, bgr=False):
+
+        return self.detect_faces_batch([image], conf_th=conf_th, scales=scales, top_k=top_k, bgr=bgr)[0]
 
-        w, h = image.shape[1], image.shape[0]
+    def detect_faces_batch(self, images, conf_th=0.8, scales=[1], top_k=750, bgr=False):
 
-        bboxes = np.empty(shape=(0, 5))
+        # Same-size frames go through the network as one NCHW batch per scale.
+        # conf_th and top_k go down to Detect, so only priors over conf_th are
+        # decoded and suppressed. Returns one (n, 5) array of x1, y1, x2, y2,
+        # score per frame.
+        w, h = images[0].shape[1], images[0].shape[0]
+
+        bboxes = [np.empty(shape=(0, 5)) for _ in images]
 
         with torch.no_grad():
             for s in scales:
-                scaled_img = cv2.resize(image, dsize=(0, 0), fx=s, fy=s, interpolation=cv2.INTER_LINEAR)
-
-                scaled_img = np.swapaxes(scaled_img, 1, 2)
-                scaled_img = np.swapaxes(scaled_img, 1, 0)
-                scaled_img = scaled_img[[2, 1, 0], :, :]
-                scaled_img = scaled_img.astype('float32')
-                scaled_img -= img_mean
-                scaled_img = scaled_img[[2, 1, 0], :, :]
-                x = torch.from_numpy(scaled_img).unsqueeze(0).to(self.device)
-                y = self.net(x)
-
-                detections = y.data
-                scale = torch.Tensor([w, h, w, h])
-
-                for i in range(detections.size(1)):
-                    j = 0
-                    while detections[0, i, j, 0] > conf_th:
-                        score = detections[0, i, j, 0]
-                        pt = (detections[0, i, j, 1:] * scale).cpu().numpy()
-                        bbox = (pt[0], pt[1], pt[2], pt[3], score)
-                        bboxes = np.vstack((bboxes, bbox))
-                        j += 1
-
-            keep = nms_(bboxes, 0.1)
-            bboxes = bboxes[keep]
+                with self.stage('det_preprocess', len(images)):
+                    x = self.preprocess(images, s, bgr)
+
+                with self.stage('det_network', len(images)):
+                    y = self.net(x, conf_th=conf_th, top_k=top_k)
+
+                with self.stage('det_nms', len(images)):
+                    # Detections are sorted by decreasing score with zero padding,
+                    # so the mask selects the prefix above conf_th of each class
+                    detections = y.data.cpu()
+                    scale = torch.Tensor([w, h, w, h])
+
+                    for b in range(detections.size(0)):
+                        dets = detections[b][detections[b, :, :, 0] > conf_th]
+                        dets = torch.cat((dets[:, 1:] * scale, dets[:, :1]), 1)
+                        bboxes[b] = np.concatenate((bboxes[b], dets.numpy().astype(np.float64)), 0)
+
+            with self.stage('det_merge', len(images)):
+                for b in range(len(bboxes)):
+                    keep = nms_boxes(bboxes[b], 0.1)
+                    bboxes[b] = bboxes[b][keep]
 
         return bboxes
@@ -1,11 +1,16 @@
 import numpy as np
-from itertools import product as product
 import torch
 from torch.autograd import Function
 
+try:
+    from torchvision.ops import batched_nms as tv_batched_nms
+except ImportError:
+    tv_batched_nms = None
+
 
 def nms_(dets, thresh):
     """
+    Reference loop version of nms_boxes.
     Courtesy of Ross Girshick
     [https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/nms/py_cpu_nms.py]
     """
@@ -38,6 +43,61 @@ def nms_(dets, thresh):
     return np.array(keep).astype(int)
 
 
+def box_iou(a, b):
+    """Pairwise IoU of [N,4] and [M,4] corner boxes, with the areas of nms_"""
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+
+    lt = torch.max(a[:, None, :2], b[None, :, :2])
+    rb = torch.min(a[:, None, 2:], b[None, :, 2:])
+    inter = (rb - lt).clamp(min=0).prod(2)
+
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def batched_nms(boxes, scores, idxs, overlap):
+    """Greedy NMS within each group of idxs, all groups at once.
+    Boxes with IoU above overlap with a higher scoring box of the same group are
+    suppressed, as in nms and nms_. Returns the kept indices by decreasing score.
+    Uses torchvision when available, otherwise an IoU matrix per group.
+    """
+    if tv_batched_nms is not None:
+        return tv_batched_nms(boxes, scores, idxs, overlap)
+
+    if boxes.numel() == 0:
+        return torch.zeros(0, dtype=torch.long)
+
+    keep = []
+    for group in torch.unique(idxs):
+        order = torch.nonzero(idxs == group).view(-1)
+        order = order[scores[order].argsort(descending=True)]
+        suppress = (box_iou(boxes[order], boxes[order]) > overlap).numpy()
+
+        removed = np.zeros(len(order), dtype=bool)
+        kept = []
+        for i in range(len(order)):
+            if not removed[i]:
+                kept.append(i)
+                removed |= suppress[i]
+
+        keep.append(order[torch.LongTensor(kept)])
+
+    keep = torch.cat(keep)
+
+    return keep[scores[keep].argsort(descending=True)]
+
+
+def nms_boxes(dets, thresh):
+    """Vectorized nms_ over an (n, 5) array of x1, y1, x2, y2, score"""
+    if len(dets) == 0:
+        return np.zeros(0, dtype=int)
+
+    dets = torch.from_numpy(np.ascontiguousarray(dets))
+    keep = batched_nms(dets[:, :4], dets[:, 4], torch.zeros(len(dets), dtype=torch.long), thresh)
+
+    return keep.numpy().astype(int)
+
+
 def decode(loc, priors, variances):
     """Decode locations from predictions using priors to undo
     the encoding we did for offset regression at train time.
@@ -61,7 +121,8 @@ def decode(loc, priors, variances):
 
 def nms(boxes, scores, overlap=0.5, top_k=200):
     """Apply non-maximum suppression at test time to avoid detecting too many
-    overlapping bounding boxes for a given object.
+    overlapping bounding boxes for a given object. Reference loop version,
+    Detect uses batched_nms.
     Args:
         boxes: (tensor) The location preds for the img, Shape: [num_priors,4].
         scores: (tensor) The class predscores for the img, Shape:[num_priors].
@@ -139,36 +200,46 @@ class Detect(object):
         self.variance = variance
         self.nms_top_k = nms_top_k
 
-    def forward(self, loc_data, conf_data, prior_data):
+    def forward(self, loc_data, conf_data, prior_data, conf_thresh=None, top_k=None):
+        # conf_thresh and top_k override the defaults per call. Callers that only
+        # keep detections above their own threshold should pass it: boxes above it
+        # can only be suppressed by higher scoring boxes, so the result for them is
+        # the same, and only the priors above it are decoded and suppressed.
+        conf_thresh = self.conf_thresh if conf_thresh is None else conf_thresh
+        top_k = self.top_k if top_k is None else top_k
 
         num = loc_data.size(0)
         num_priors = prior_data.size(0)
 
         conf_preds = conf_data.view(num, num_priors, self.num_classes).transpose(2, 1)
-        batch_priors = prior_data.view(-1, num_priors, 4).expand(num, num_priors, 4)
-        batch_priors = batch_priors.contiguous().view(-1, 4)
 
-        decoded_boxes = decode(loc_data.view(-1, 4), batch_priors, self.variance)
-        decoded_boxes = decoded_boxes.view(num, num_priors, 4)
+        output = torch.zeros(num, self.num_classes, top_k, 5)
+
+        for cl in range(1, self.num_classes):
+            # Priors over conf_thresh, at most the nms_top_k best of each image
+            mask = conf_preds[:, cl].gt(conf_thresh)
+            image, idx = mask.nonzero(as_tuple=True)
+            scores = conf_preds[:, cl][image, idx]
 
-        output = torch.zeros(num, self.num_classes, self.top_k, 5)
+            if len(scores) > self.nms_top_k and mask.sum(1).max() > self.nms_top_k:
+                scores, idx = conf_preds[:, cl].topk(self.nms_top_k, dim=1)
+                valid = scores.gt(conf_thresh)
 
-        for i in range(num):
-            boxes = decoded_boxes[i].clone()
-            conf_scores = conf_preds[i].clone()
+                image = torch.arange(num).unsqueeze(1).expand_as(idx)[valid]
+                idx = idx[valid]
+                scores = scores[valid]
 
-            for cl in range(1, self.num_classes):
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                scores = conf_scores[cl][c_mask]
-                
-                if scores.dim() == 0:
-                    continue
-                l_mask = c_mask.unsqueeze(1).expand_as(boxes)
-                boxes_ = boxes[l_mask].view(-1, 4)
-                ids, count = nms(boxes_, scores, self.nms_thresh, self.nms_top_k)
-                count = count if count < self.top_k else self.top_k
+            # Only the candidates are decoded, then suppressed per image in one batched NMS
+            boxes = decode(loc_data[image, idx], prior_data[idx], self.variance)
 
-                output[i, cl, :count] = torch.cat((scores[ids[:count]].unsqueeze(1), boxes_[ids[:count]]), 1)
+            keep = batched_nms(boxes, scores, image, self.nms_thresh)
+            image, scores, boxes = image[keep], scores[keep], boxes[keep]
+
+            # Rank of each kept box within its image, in order of decreasing score
+            rank = torch.nn.functional.one_hot(image, num).cumsum(0)[torch.arange(len(image)), image] - 1
+            top = rank.lt(top_k)
+
+            output[image[top], cl, rank[top]] = torch.cat((scores[top].unsqueeze(1), boxes[top]), 1)
 
         return output
 
@@ -193,23 +264,29 @@ class PriorBox(object):
         self.clip = clip
 
     def forward(self):
+        # Cells in row-major order per feature map, in float64 like the Python
+        # floats of the per-cell loop this replaces, then rounded to float32
         mean = []
         for k, fmap in enumerate(self.feature_maps):
             feath = fmap[0]
             featw = fmap[1]
-            for i, j in product(range(feath), range(featw)):
-                f_kw = self.imw / self.steps[k]
-                f_kh = self.imh / self.steps[k]
 
-                cx = (j + 0.5) / f_kw
-                cy = (i + 0.5) / f_kh
+            f_kw = self.imw / self.steps[k]
+            f_kh = self.imh / self.steps[k]
+
+            cx = (torch.arange(featw, dtype=torch.float64) + 0.5) / f_kw
+            cy = (torch.arange(feath, dtype=torch.float64) + 0.5) / f_kh
 
-                s_kw = self.min_sizes[k] / self.imw
-                s_kh = self.min_sizes[k] / self.imh
+            s_kw = self.min_sizes[k] / self.imw
+            s_kh = self.min_sizes[k] / self.imh
 
-                mean += [cx, cy, s_kw, s_kh]
+            mean.append(torch.stack((
+                cx.unsqueeze(0).expand(feath, featw).reshape(-1),
+                cy.unsqueeze(1).expand(feath, featw).reshape(-1),
+                torch.full((feath * featw,), s_kw, dtype=torch.float64),
+                torch.full((feath * featw,), s_kh, dtype=torch.float64)), 1))
 
-        output = torch.FloatTensor(mean).view(-1, 4)
+        output = torch.cat(mean, 0).float()
         
         if self.clip:
             output.clamp_(max=1, min=0)
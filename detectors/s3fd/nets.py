@@ -106,8 +106,17 @@ class S3FDNet(nn.Module):
         self.softmax = nn.Softmax(dim=-1)
         self.detect = Detect()
 
-    def forward(self, x):
-        size = x.size()[2:]
+        # Border the input carries instead of the first convolution's padding, see fold_input_mean
+        self.input_pad = 0
+
+        # Priors per (input size, feature map shapes), on self.device
+        self.prior_cache = {}
+        self.prior_cache_size = 8
+
+    def forward(self, x, conf_th=None, top_k=None):
+        # conf_th and top_k are passed on to Detect, the defaults keep all
+        # detections over 0.05 and at most 750 per image
+        size = (x.size(2) - 2 * self.input_pad, x.size(3) - 2 * self.input_pad)
         sources = list()
         loc = list()
         conf = list()
@@ -161,14 +170,43 @@ class S3FDNet(nn.Module):
         loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
         conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
 
-        with torch.no_grad():
-            self.priorbox = PriorBox(size, features_maps)
-            self.priors = self.priorbox.forward()
+        self.priors = self.get_priors(size, features_maps)
 
         output = self.detect.forward(
             loc.view(loc.size(0), -1, 4),
             self.softmax(conf.view(conf.size(0), -1, 2)),
-            self.priors.type(type(x.data)).to(self.device)
+            self.priors,
+            conf_thresh=conf_th,
+            top_k=top_k
         )
 
         return output
+
+    def fold_input_mean(self, mean):
+        # Moves the per-channel mean subtraction into the first convolution's bias.
+        # Zero padding of x - mean is padding x with the mean, so the convolution
+        # stops padding and the input must come with a one pixel border of the mean.
+        conv = self.vgg[0]
+        folded = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, padding=0)
+
+        with torch.no_grad():
+            mean = torch.as_tensor(mean, dtype=conv.weight.dtype, device=conv.weight.device)
+            folded.weight.copy_(conv.weight)
+            folded.bias.copy_(conv.bias - (conv.weight * mean.view(1, -1, 1, 1)).sum((1, 2, 3)))
+
+        self.vgg[0] = folded.to(conv.weight.device)
+        self.input_pad = conv.padding[0]
+
+    def get_priors(self, size, features_maps):
+        # Priors only depend on the input size, so all frames of a video share them
+        key = (tuple(size), tuple(tuple(fmap) for fmap in features_maps))
+
+        if key not in self.prior_cache:
+            if len(self.prior_cache) >= self.prior_cache_size:
+                self.prior_cache.clear()
+
+            with torch.no_grad():
+                self.priorbox = PriorBox(size, features_maps)
+                self.prior_cache[key] = self.priorbox.forward().to(self.device)
+
+        return self.prior_cache[key]
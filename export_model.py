@@ -0,0 +1,26 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import argparse, os
+
+from SyncNetInstance import *
+
+# ==================== PARSE ARGUMENT ====================
+
+parser = argparse.ArgumentParser(description = "Export SyncNet graphs next to the weights");
+parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
+parser.add_argument('--fuse_bn', action='store_true', help='Fold BatchNorm layers before exporting');
+parser.add_argument('--onnx', action='store_true', help='Also write ONNX graphs for onnxruntime');
+opt = parser.parse_args();
+
+# ==================== LOAD MODEL ====================
+
+s = SyncNetInstance();
+
+s.loadParameters(opt.initial_model, fuse=opt.fuse_bn, compiled=False);
+print("Model %s loaded."%opt.initial_model);
+
+# ==================== EXPORT ====================
+
+# The weights digest and fuse flag let loadParameters reject graphs of other weights
+export(s.__S__, os.path.splitext(opt.initial_model)[0], onnx=opt.onnx, info={'weights': file_digest(opt.initial_model), 'fuse': opt.fuse_bn})
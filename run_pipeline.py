@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import sys, time, os, pdb, argparse, pickle, subprocess, glob, cv2
+import sys, time, os, pdb, argparse, pickle, subprocess, glob, cv2, json
 import numpy as np
 from shutil import rmtree
 
@@ -16,6 +16,7 @@ from scipy.io import wavfile
 from scipy import signal
 
 from detectors import S3FD
+from SyncNetProfiler import Profiler, NULL_PROFILER
 
 # ========== ========== ========== ==========
 # # PARSE ARGS
@@ -31,6 +32,9 @@ parser.add_argument('--min_track',      type=int, default=100,  help='Minimum fa
 parser.add_argument('--frame_rate',     type=int, default=25,   help='Frame rate');
 parser.add_argument('--num_failed_det', type=int, default=25,   help='Number of missed detections allowed before tracking is stopped');
 parser.add_argument('--min_face_size',  type=int, default=100,  help='Minimum face size in pixels');
+parser.add_argument('--facedet_batch',  type=int, default=8,    help='Number of frames per face detection forward pass');
+parser.add_argument('--facedet_fold_mean', action='store_true', help='Subtract the face detector input mean in its first convolution');
+parser.add_argument('--profile',        action='store_true',    help='Save face detection stage times to profile_facedet.json');
 opt = parser.parse_args();
 
 setattr(opt,'avi_dir',os.path.join(opt.data_dir,'pyavi'))
@@ -184,35 +188,45 @@ def crop_video(opt,track,cropfile):
 
 def inference_video(opt):
 
-  DET = S3FD(device='cpu')
+  profiler = Profiler() if opt.profile else NULL_PROFILER
+
+  DET = S3FD(device='cpu', profiler=profiler, fold_mean=opt.facedet_fold_mean)
 
   flist = glob.glob(os.path.join(opt.frames_dir,opt.reference,'*.jpg'))
   flist.sort()
 
   dets = []
       
-  for fidx, fname in enumerate(flist):
+  for bidx in range(0, len(flist), opt.facedet_batch):
 
     start_time = time.time()
-    
-    image = cv2.imread(fname)
 
-    image_np = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    bboxes = DET.detect_faces(image_np, conf_th=0.9, scales=[opt.facedet_scale])
+    images = []
+    for fname in flist[bidx:bidx+opt.facedet_batch]:
+      with profiler.stage('decode'):
+        images.append(cv2.imread(fname))
+
+    batch_bboxes = DET.detect_faces_batch(images, conf_th=0.9, scales=[opt.facedet_scale], bgr=True)
 
-    dets.append([]);
-    for bbox in bboxes:
-      dets[-1].append({'frame':fidx, 'bbox':(bbox[:-1]).tolist(), 'conf':bbox[-1]})
+    elapsed_time = (time.time() - start_time) / len(images)
 
-    elapsed_time = time.time() - start_time
+    for fidx, bboxes in enumerate(batch_bboxes, bidx):
 
-    print('%s-%05d; %d dets; %.2f Hz' % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),fidx,len(dets[-1]),(1/elapsed_time))) 
+      dets.append([]);
+      for bbox in bboxes:
+        dets[-1].append({'frame':fidx, 'bbox':(bbox[:-1]).tolist(), 'conf':bbox[-1]})
+
+      print('%s-%05d; %d dets; %.2f Hz' % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),fidx,len(dets[-1]),(1/elapsed_time))) 
 
   savepath = os.path.join(opt.work_dir,opt.reference,'faces.pckl')
 
   with open(savepath, 'wb') as fil:
     pickle.dump(dets, fil)
 
+  if opt.profile:
+    with open(os.path.join(opt.work_dir,opt.reference,'profile_facedet.json'), 'w') as fil:
+      json.dump(profiler.summary(), fil, indent=2)
+
   return dets
 
 # ========== ========== ========== ==========
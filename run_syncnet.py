@@ -1,9 +1,10 @@
 #!/usr/bin/python
 #-*- coding: utf-8 -*-
 
-import time, pdb, argparse, subprocess, pickle, os, gzip, glob
+import time, pdb, argparse, subprocess, pickle, os, gzip, glob, json
 
 from SyncNetInstance import *
+from SyncNetProfiler import Profiler
 
 # ==================== PARSE ARGUMENT ====================
 
@@ -11,6 +12,23 @@ parser = argparse.ArgumentParser(description = "SyncNet");
 parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
 parser.add_argument('--batch_size', type=int, default='20', help='');
 parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--search', type=str, default='full', choices=['full','adaptive','fft'], help='Offset search over +-vshift: exhaustive, coarse-to-fine from +-vshift_init, or FFT cross-correlation for large vshift');
+parser.add_argument('--vshift_init', type=int, default='3', help='Initial half-width of the adaptive search');
+parser.add_argument('--fuse_bn', action='store_true', help='Fold BatchNorm layers into the preceding conv/linear layers at load time');
+parser.add_argument('--engine', type=str, default='torch', choices=['torch','onnx'], help='Runtime for graphs exported by export_model.py, used when they are present');
+parser.add_argument('--decode', type=str, default='disk', choices=['disk','pipe'], help='Decode via JPEG/WAV files in tmp_dir, or stream raw frames and PCM from an ffmpeg pipe');
+parser.add_argument('--auto_batch', action='store_true', help='Pick the batch size from a throughput calibration and the available memory, cached per host');
+parser.add_argument('--batch_cache', type=str, default='~/.cache/syncnet/batch_size.json', help='Cache of calibrated batch sizes');
+parser.add_argument('--pipeline', action='store_true', help='Prepare batches in a background thread and run the lip and audio towers concurrently');
+parser.add_argument('--stream', action='store_true', help='Decode from an ffmpeg pipe in rolling windows so memory does not grow with track length');
+parser.add_argument('--quantize', type=str, default='none', choices=['none','dynamic','static'], help='int8 CPU inference: dynamic quantizes the Linear heads, static also the conv trunks');
+parser.add_argument('--calibration_dir', type=str, default='', help='Clips to calibrate static quantization on, the tracks of the reference by default');
+parser.add_argument('--calibration_clips', type=int, default='4', help='Number of clips used for calibration');
+parser.add_argument('--cache_dir', type=str, default='', help='Embedding store, reruns with other search settings skip decoding and the forward passes');
+parser.add_argument('--cache_size', type=float, default='10', help='Embedding store size limit in GB, least recently used tracks are evicted');
+parser.add_argument('--timeline', type=float, default='0', help='Window in seconds of a sliding offset/confidence timeline saved to timeline.pckl, 0 to disable');
+parser.add_argument('--timeline_hop', type=float, default='1', help='Step in seconds between timeline windows');
+parser.add_argument('--profile', action='store_true', help='Save per-stage times and item counts to profile.json');
 parser.add_argument('--data_dir', type=str, default='data/work', help='');
 parser.add_argument('--videofile', type=str, default='', help='');
 parser.add_argument('--reference', type=str, default='', help='');
@@ -26,32 +44,62 @@ setattr(opt,'crop_dir',os.path.join(opt.data_dir,'pycrop'))
 
 s = SyncNetInstance();
 
-s.loadParameters(opt.initial_model);
+s.loadParameters(opt.initial_model, fuse=opt.fuse_bn, compiled=(opt.quantize == 'none'), engine=opt.engine);
 print("Model %s loaded."%opt.initial_model);
 
 flist = glob.glob(os.path.join(opt.crop_dir,opt.reference,'0*.avi'))
 flist.sort()
 
+if opt.quantize != 'none':
+    if opt.calibration_dir != '':
+        clist = sorted(glob.glob(os.path.join(opt.calibration_dir,'*.avi')))
+    else:
+        clist = flist
+    s.quantizeModel(opt, clist[:opt.calibration_clips], static=(opt.quantize == 'static'))
+
+if opt.auto_batch:
+    s.autoBatchSize(opt, cache_file=opt.batch_cache)
+
+if opt.profile:
+    s.profiler = Profiler()
+
 # ==================== GET OFFSETS ====================
 
 dists = []
 offsets = []
 confs = []
-for idx, fname in enumerate(flist):
-    offset, conf, dist = s.evaluate(opt,videofile=fname)
-    offsets.append(offset)
-    confs.append(conf)
-    dists.append(dist)
+timelines = []
+results, summary = s.evaluate_tracks(opt,videofiles=flist,timeline=(opt.timeline > 0),profile=True)
+
+for result in results:
+    offsets.append(result[0])
+    confs.append(result[1])
+    dists.append(result[2])
+    timelines.append(result[3:])
       
 # ==================== PRINT RESULTS TO FILE ====================
 
 with open(os.path.join(opt.work_dir,opt.reference,'activesd.pckl'), 'wb') as fil:
     pickle.dump(dists, fil)
 
+if opt.timeline > 0:
+    with open(os.path.join(opt.work_dir,opt.reference,'timeline.pckl'), 'wb') as fil:
+        pickle.dump([ timeline for timeline, in timelines ], fil)
+
 # ==================== SAVE OFFSETS TO TXT FILE ====================
 
 with open(os.path.join(opt.work_dir,opt.reference,'offsets.txt'), 'w') as fil:
     for idx, (offset, conf) in enumerate(zip(offsets, confs)):
         fil.write('TRACK %d: OFFSET %d, CONF %.3f\n'%(idx, offset, conf))
 
+# Batch size used, after --auto_batch and any halving on allocation failures
+with open(os.path.join(opt.work_dir,opt.reference,'batch_size.txt'), 'w') as fil:
+    fil.write('%d\n'%opt.batch_size)
+
 print("Offset results saved to %s" % os.path.join(opt.work_dir,opt.reference,'offsets.txt'))
+
+if opt.profile:
+    with open(os.path.join(opt.work_dir,opt.reference,'profile.json'), 'w') as fil:
+        json.dump(summary, fil, indent=2)
+    for name, stats in summary.items():
+        print('%-10s %8.3f sec, %8d items, %5d calls' % (name, stats['seconds'], stats['items'], stats['calls']))
@@ -40,11 +40,11 @@ faces = [[] for i in range(len(flist))]
 
 for tidx, track in enumerate(tracks):
 
-	mean_dists 	=  numpy.mean(numpy.stack(dists[tidx],1),1)
+	mean_dists 	=  numpy.mean(dists[tidx],0)
 	minidx 		= numpy.argmin(mean_dists,0)
 	minval 		= mean_dists[minidx] 
 	
-	fdist   	= numpy.stack([dist[minidx] for dist in dists[tidx]])
+	fdist   	= dists[tidx][:,minidx]
 	fdist   	= numpy.pad(fdist, (3,3), 'constant', constant_values=10)
 
 	fconf   = numpy.median(mean_dists) - fdist
@@ -0,0 +1,713 @@
+#!/usr/bin/env python3
+"""
+Equivalence tests for the SyncNet inference paths
+"""
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import cv2
+import numpy
+import python_speech_features
+import torch
+
+# Add the current directory to the path so we can import our modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import SyncNetInstance as syncnet_instance
+from SyncNetInstance import SyncNetInstance, calc_pdist, calc_pdist_adaptive, calc_pdist_fft, calc_timeline, lip_worker, pack_tracks, prefetch, resize_npy
+from SyncNetMFCC import mfcc, mfcc_batch
+from SyncNetModel import S, fuse_bn, export, load_compiled, load_export_info
+from SyncNetMonitor import SyncNetMonitor, EmbeddingRing
+from SyncNetProfiler import Profiler, NULL_PROFILER, NULL_STAGE
+from SyncNetStore import EmbeddingStore
+from detectors.s3fd import S3FD, img_mean
+from detectors.s3fd import box_utils
+from detectors.s3fd.box_utils import Detect, PriorBox, batched_nms, nms, nms_, nms_boxes
+
+
+def make_shifted_feats(n, lag, dim=64):
+    """Lip/audio features where the audio matches the lip features lag frames later.
+    Both are windows of one random walk, so the distance grows with the lag error."""
+
+    torch.manual_seed(abs(lag))
+    pad = 32 + abs(lag)
+    walk = torch.randn(n + 2*pad, dim).cumsum(0)
+
+    feat1 = walk[pad:pad+n]
+    feat2 = walk[pad-lag:pad-lag+n] + 0.1*torch.randn(n, dim)
+
+    return feat1, feat2
+
+
+def make_model():
+    """Randomly initialised S in eval mode, with non-trivial BatchNorm statistics"""
+
+    torch.manual_seed(0)
+    model = S(num_layers_in_fc_layers=1024)
+
+    for module in model.modules():
+        if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+
+    return model.eval()
+
+
+def calc_pdist_loop(feat1, feat2, vshift=10):
+    """Reference per-frame implementation the vectorized calc_pdist replaces"""
+
+    win_size = vshift*2+1
+
+    feat2p = torch.nn.functional.pad(feat2,(0,0,vshift,vshift))
+
+    dists = []
+
+    for i in range(0,len(feat1)):
+
+        dists.append(torch.nn.functional.pairwise_distance(feat1[[i],:].repeat(win_size, 1), feat2p[i:i+win_size,:]))
+
+    return torch.stack(dists,0)
+
+
+def priorbox_loop(input_size, feature_maps, min_sizes=[16, 32, 64, 128, 256, 512], steps=[4, 8, 16, 32, 64, 128]):
+    """Reference per-cell implementation the vectorized PriorBox replaces"""
+
+    imh, imw = input_size
+    mean = []
+    for k, (feath, featw) in enumerate(feature_maps):
+        for i in range(feath):
+            for j in range(featw):
+                mean += [(j + 0.5) / (imw / steps[k]), (i + 0.5) / (imh / steps[k]), min_sizes[k] / imw, min_sizes[k] / imh]
+
+    return torch.FloatTensor(mean).view(-1, 4)
+
+
+def test_calc_pdist_matches_loop():
+    """The banded GEMM distance matrix matches the per-frame pairwise_distance loop"""
+
+    torch.manual_seed(0)
+    feat1 = torch.randn(97, 1024)
+    feat2 = torch.randn(97, 1024)
+
+    for vshift in [1, 5, 15]:
+        dists = calc_pdist(feat1, feat2, vshift=vshift)
+        reference = calc_pdist_loop(feat1, feat2, vshift=vshift)
+
+        assert dists.shape == (97, 2*vshift+1)
+        assert torch.allclose(dists, reference, atol=1e-4)
+        assert torch.equal(torch.argmin(dists.mean(0)), torch.argmin(reference.mean(0)))
+
+
+def test_adaptive_search_matches_exhaustive():
+    """The coarse-to-fine search finds the exhaustive offset with fewer evaluations"""
+
+    vshift = 15
+    for lag in [0, 2, -3, 5, -9, 14]:
+        feat1, feat2 = make_shifted_feats(200, lag)
+
+        full = calc_pdist(feat1, feat2, vshift=vshift)
+        dists, v = calc_pdist_adaptive(feat1, feat2, vshift_init=3, vshift=vshift)
+
+        assert v - int(torch.argmin(dists.mean(0))) == vshift - int(torch.argmin(full.mean(0))) == -lag
+        assert torch.allclose(dists, full[:, vshift-v:vshift+v+1], atol=1e-5)
+        assert dists.numel() <= full.numel()
+        if abs(lag) < 3:
+            assert v == 3
+
+
+def test_fft_search_matches_exhaustive():
+    """The FFT estimator finds large offsets with an unbiased confidence, and is exhaustive
+    when nmedian covers every lag"""
+
+    for lag in [0, -4, 37, -120]:
+        feat1, feat2 = make_shifted_feats(400, lag)
+        dists, lags, background = calc_pdist_fft(feat1, feat2, maxlag=150)
+
+        assert -int(lags[torch.argmin(dists.mean(0))]) == -lag
+        assert dists.shape == (400, len(lags))
+        assert len(lags) < 2*150+1 and len(background) == 31
+
+        # The confidence (median minus minimum mean distance) of the exhaustive search
+        full = calc_pdist(feat1, feat2, vshift=150).mean(0)
+        mdist = dists.mean(0)
+        conf = float(mdist[background].median() - mdist.min())
+        assert abs(conf - float(full.median() - full.min())) < 0.1*float(full.median() - full.min())
+
+    feat1, feat2 = make_shifted_feats(200, 6)
+    dists, lags, background = calc_pdist_fft(feat1, feat2, maxlag=15, nmedian=31)
+
+    assert torch.equal(lags, torch.arange(-15, 16)) and torch.equal(background, torch.arange(31))
+    assert torch.allclose(dists, calc_pdist(feat1, feat2, vshift=15), atol=1e-5)
+
+
+def test_timeline_follows_drift():
+    """Window offsets from the cumulative distances follow a drifting offset"""
+
+    early1, early2 = make_shifted_feats(150, 2)
+    late1, late2 = make_shifted_feats(150, -3)
+    feat1, feat2 = torch.cat((early1, late1), 0), torch.cat((early2, late2), 0)
+
+    dists = calc_pdist(feat1, feat2, vshift=15)
+    timeline = calc_timeline(dists, torch.arange(-15, 16), window=50, hop=25)
+
+    assert timeline.shape == (11, 4)
+    assert list(timeline[:4, 1]) == [-2]*4 and list(timeline[-4:, 1]) == [3]*4
+
+    window = dists[100:150].mean(0)
+    assert numpy.allclose(timeline[4, 2:], [float(window.median() - window.min()), float(window.min())], atol=1e-4)
+
+
+def test_prefetch_keeps_order_and_errors():
+    """Batches prepared in the background arrive in order, producer errors reach the consumer,
+    and the producer is joined when the consumer stops"""
+
+    assert list(prefetch(iter(range(50)), depth=3)) == list(range(50))
+
+    def failing():
+        yield 1
+        raise ValueError('decode failed')
+
+    items = []
+    try:
+        for item in prefetch(failing()):
+            items.append(item)
+        assert False
+    except ValueError:
+        assert items == [1]
+
+    # A consumer that stops early, e.g. on an allocation failure, stops the producer
+    threads = threading.active_count()
+    batches = prefetch(iter(range(1000)), depth=2)
+    assert [next(batches) for _ in range(3)] == [0, 1, 2]
+    batches.close()
+    assert threading.active_count() == threads
+
+
+def test_concurrent_towers_match_sequential():
+    """The lip tower in the worker thread gives the sequential embeddings without tracking grad"""
+
+    instance = SyncNetInstance()
+    instance.__S__ = make_model()
+
+    clip = torch.rand(1, 3, 9, 224, 224) * 255
+    strip = torch.randn(1, 1, 13, 4*4+20) * 10
+
+    worker = lip_worker(1)
+    try:
+        with torch.no_grad():
+            im_out, cc_out = instance.forward_towers_concurrent(worker, clip, strip, 5, dict(lip=0., audio=0., wait=0.))
+            im_ref, cc_ref = instance.forward_towers(clip, strip, 5)
+    finally:
+        worker.shutdown()
+
+    assert not im_out.requires_grad and not cc_out.requires_grad
+    assert torch.allclose(im_out, im_ref, rtol=1e-4, atol=1e-3)
+    assert torch.allclose(cc_out, cc_ref, rtol=1e-4, atol=1e-4)
+
+
+def test_profiler_stages_and_hooks():
+    """Stages accumulate time and items and reach the hooks, disabled profilers record nothing"""
+
+    calls = []
+    profiler = Profiler(hooks=[lambda name, seconds, count: calls.append((name, count))])
+
+    for _ in range(3):
+        with profiler.stage('lip', 20):
+            pass
+    profiler.add('decode', 0.5, 100)
+
+    summary = profiler.summary()
+    assert summary['lip']['calls'] == 3 and summary['lip']['items'] == 60
+    assert summary['decode'] == {'calls': 1, 'seconds': 0.5, 'items': 100}
+    assert calls == [('lip', 20)]*3 + [('decode', 100)]
+
+    assert NULL_PROFILER.stage('lip') is NULL_STAGE
+    NULL_PROFILER.add('decode', 1.0)
+    assert NULL_PROFILER.summary() == {}
+
+
+def test_embedding_store_hits_and_evicts():
+    """Stored embeddings come back for the same crop, weights and decode path, and the least
+    recently used entries are evicted first"""
+
+    with tempfile.TemporaryDirectory(prefix='syncnet_store_') as tmp:
+        videofile = os.path.join(tmp, 'track.avi')
+        with open(videofile, 'wb') as f:
+            f.write(b'crop')
+
+        store = EmbeddingStore(os.path.join(tmp, 'store'), max_bytes=1<<30)
+        im_feat, cc_feat = torch.randn(10, 4), torch.randn(10, 4)
+
+        keys = [store.key(videofile, 'weights', frames) for frames in ['disk', 'raw']] + [store.key(videofile, 'other')]
+        assert len(set(keys)) == 3 and store.key(videofile, 'weights') == keys[0]
+
+        store.put(keys[0], im_feat, cc_feat)
+        entry = sum(os.path.getsize(fname) for fname in store.files(keys[0]))
+        store.max_bytes = 2*entry
+
+        assert all(torch.equal(a, b) for a, b in zip(store.get(keys[0]), (im_feat, cc_feat)))
+        assert store.get(keys[1]) is None
+
+        # keys[1] is older than keys[0] until keys[0] is read, then it is evicted first
+        store.put(keys[1], im_feat, cc_feat)
+        for key, mtime in [(keys[0], 1000), (keys[1], 2000)]:
+            for fname in store.files(key):
+                os.utime(fname, (mtime, mtime))
+        store.get(keys[0])
+        store.put(keys[2], im_feat, cc_feat)
+
+        assert store.get(keys[1]) is None
+        assert store.get(keys[0]) is not None and store.get(keys[2]) is not None
+
+
+def test_priorbox_matches_loop():
+    """Vectorized priors are bit-identical to the per-cell loop"""
+
+    for size in [(180, 320), (224, 224), (97, 131)]:
+        fmaps = [[-(-size[0] // step), -(-size[1] // step)] for step in [4, 8, 16, 32, 64, 128]]
+        priors = PriorBox(size, fmaps).forward()
+
+        assert torch.equal(priors, priorbox_loop(size, fmaps))
+
+
+def test_vectorized_nms_matches_loops():
+    """Batched NMS keeps the boxes of the per-box loops, per group and in score order,
+    with torchvision and with the fallback used without it"""
+
+    torch.manual_seed(0)
+    xy = torch.rand(300, 2) * 100
+    boxes = torch.cat((xy, xy + 10 + torch.rand(300, 2) * 30), 1)
+    scores = torch.rand(300)
+    groups = torch.randint(0, 3, (300,))
+    dets = torch.cat((boxes, scores.unsqueeze(1)), 1).double().numpy()
+
+    tv_batched_nms = box_utils.tv_batched_nms
+    try:
+        for implementation in [tv_batched_nms, None]:
+            box_utils.tv_batched_nms = implementation
+
+            keep = batched_nms(boxes, scores, groups, 0.3)
+            assert torch.equal(keep, keep[scores[keep].argsort(descending=True)])
+            for g in range(3):
+                idx = torch.nonzero(groups == g).view(-1)
+                ids, count = nms(boxes[idx], scores[idx], 0.3, 5000)
+                assert torch.equal(keep[groups[keep] == g], idx[ids[:count]])
+
+            assert numpy.array_equal(nms_boxes(dets, 0.1), nms_(dets, 0.1))
+            assert len(nms_boxes(numpy.empty((0, 5)), 0.1)) == 0
+    finally:
+        box_utils.tv_batched_nms = tv_batched_nms
+
+
+def test_detect_threshold_pushdown():
+    """Passing the caller's threshold to Detect keeps exactly the detections above it"""
+
+    size = (90, 160)
+    priors = PriorBox(size, [[-(-size[0] // step), -(-size[1] // step)] for step in [4, 8, 16, 32, 64, 128]]).forward()
+
+    torch.manual_seed(0)
+    loc = torch.randn(3, len(priors), 4) * 0.5
+    conf = torch.softmax(torch.randn(3, len(priors), 2) * 3, -1)
+
+    full = Detect().forward(loc, conf, priors)
+    pushed = Detect().forward(loc, conf, priors, conf_thresh=0.9, top_k=50)
+
+    assert pushed.shape == (3, 2, 50, 5)
+    for b in range(3):
+        reference = full[b, 1][full[b, 1, :, 0] > 0.9][:50]
+        assert torch.allclose(pushed[b, 1][pushed[b, 1, :, 0] > 0.9], reference)
+
+
+def test_s3fd_fused_preprocessing():
+    """The fused input buffer is bit-identical to the per-step preprocessing, also from BGR frames,
+    and folding the mean into the first convolution gives the same activations"""
+
+    rng = numpy.random.RandomState(0)
+    images = [rng.randint(0, 256, (72, 128, 3)).astype(numpy.uint8) for _ in range(3)]
+
+    reference = []
+    for image in images:
+        scaled_img = cv2.resize(image, dsize=(0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
+        scaled_img = numpy.swapaxes(numpy.swapaxes(scaled_img, 1, 2), 1, 0)[[2, 1, 0], :, :].astype('float32')
+        scaled_img -= img_mean
+        reference.append(scaled_img[[2, 1, 0], :, :])
+    reference = torch.from_numpy(numpy.stack(reference, 0))
+
+    torch.manual_seed(0)
+    det = S3FD(weights=None)
+    torch.manual_seed(0)
+    folded = S3FD(weights=None, fold_mean=True)
+
+    assert torch.equal(det.preprocess(images, 0.5), reference)
+    assert torch.equal(det.preprocess([image[:, :, ::-1] for image in images], 0.5, bgr=True), reference)
+    assert torch.equal(det.preprocess(images[:2], 0.5), reference[:2])
+
+    with torch.no_grad():
+        assert torch.allclose(folded.net.vgg[0](folded.preprocess(images, 0.5)), det.net.vgg[0](reference), rtol=1e-4, atol=1e-2)
+
+
+def test_lip_seq_matches_windows():
+    """The sliding lip encoder gives the same embeddings as 5-frame windows"""
+
+    model = make_model()
+    clip = torch.rand(1, 3, 12, 224, 224) * 255
+
+    with torch.no_grad():
+        windows = torch.cat([clip[:,:,t:t+5] for t in range(clip.size(2)-4)], 0)
+        reference = model.forward_lip(windows)
+        seq = model.forward_lip_seq(clip)
+
+        reference_feat = model.forward_lipfeat(windows)
+        seq_feat = model.forward_lipfeat_seq(clip)
+
+    assert seq.shape == reference.shape == (8, 1024)
+    assert torch.allclose(seq, reference, rtol=1e-4, atol=1e-3)
+    assert torch.allclose(seq_feat, reference_feat, rtol=1e-4, atol=1e-3)
+
+
+def test_aud_seq_matches_windows():
+    """The audio encoder with shared strip columns and per-window halos gives the same embeddings as 20-column windows"""
+
+    model = make_model()
+    strip = torch.randn(1, 1, 13, 4*30+20) * 10
+
+    with torch.no_grad():
+        windows = torch.cat([strip[:,:,:,4*t:4*t+20] for t in range(31)], 0)
+        reference = model.forward_aud(windows)
+        seq = model.forward_aud_seq(strip, 31)
+        partial = model.forward_aud_seq(strip, 7)
+        single = model.forward_aud_seq(strip, 1)
+
+    assert seq.shape == reference.shape == (31, 1024)
+    assert torch.allclose(seq, reference, rtol=1e-4, atol=1e-4)
+    assert torch.allclose(partial, reference[:7], rtol=1e-4, atol=1e-4)
+    assert torch.allclose(single, reference[:1], rtol=1e-4, atol=1e-4)
+
+
+def test_packed_tracks_match_single_tracks():
+    """Tracks packed back to back and batched across their boundaries give the embeddings
+    and offsets of each track embedded alone, also for tracks shorter than a batch or
+    with less audio than video, and when they are packed in groups as they are decoded"""
+
+    instance = SyncNetInstance()
+    instance.__S__ = make_model()
+    opt = SimpleNamespace(batch_size=4, vshift=2)
+
+    rng = numpy.random.RandomState(0)
+    # (frames, audio frames): 6 windows, 2 windows, audio-limited 4 windows, 1 window
+    shapes = [(11, 11), (7, 7), (12, 9), (6, 6)]
+    images = [rng.randint(0, 256, (n, 224, 224, 3)).astype(numpy.uint8) for n, _ in shapes]
+    audios = [(rng.randn(m*640) * 3000).astype(numpy.int16) for _, m in shapes]
+
+    def embed(images, audios):
+        return instance.embed_packed(opt, *pack_tracks(images, audios, mfcc_batch(audios, 16000)))
+
+    with torch.no_grad():
+        packed = embed(images, audios)
+
+        for (n, m), (im_feat, cc_feat), image, audio in zip(shapes, packed, images, audios):
+            [(im_alone, cc_alone)] = embed([image], [audio])
+
+            assert im_feat.shape == cc_feat.shape == (min(n, m)-5, 1024)
+            assert torch.allclose(im_feat, im_alone, rtol=1e-4, atol=1e-3)
+            assert torch.allclose(cc_feat, cc_alone, rtol=1e-4, atol=1e-4)
+            assert instance.calc_offset(opt, im_feat, cc_feat)[0] == instance.calc_offset(opt, im_alone, cc_alone)[0]
+
+    # Decoded tracks packed in groups of at most 16 frames: (11), (7, 9), (6)
+    tracks = { 'track%d' % idx: (image, audio) for idx, (image, audio) in enumerate(zip(images, audios)) }
+    patched = syncnet_instance.read_video_pipe, syncnet_instance.read_audio_pipe, syncnet_instance.PACK_FRAMES
+    syncnet_instance.read_video_pipe = lambda videofile: tracks[videofile][0]
+    syncnet_instance.read_audio_pipe = lambda videofile, sample_rate=16000: (sample_rate, tracks[videofile][1])
+    syncnet_instance.PACK_FRAMES = 16
+    try:
+        with torch.no_grad():
+            grouped = instance.embed_tracks(SimpleNamespace(batch_size=4, decode='pipe'), sorted(tracks))
+    finally:
+        syncnet_instance.read_video_pipe, syncnet_instance.read_audio_pipe, syncnet_instance.PACK_FRAMES = patched
+
+    for (im_feat, cc_feat), (im_ref, cc_ref) in zip(grouped, packed):
+        assert torch.allclose(im_feat, im_ref, rtol=1e-4, atol=1e-3)
+        assert torch.allclose(cc_feat, cc_ref, rtol=1e-4, atol=1e-4)
+    assert len(grouped) == len(packed)
+
+
+def test_out_of_memory_backoff():
+    """A batch that fails to allocate halves the batch size, and the remaining windows give the
+    embeddings of an undisturbed run, with and without the pipeline"""
+
+    instance = SyncNetInstance()
+    instance.__S__ = make_model()
+
+    rng = numpy.random.RandomState(0)
+    images = [rng.randint(0, 256, (n, 224, 224, 3)).astype(numpy.uint8) for n in [13, 9]]
+    audios = [(rng.randn(len(image)*640) * 3000).astype(numpy.int16) for image in images]
+    packed = pack_tracks(images, audios, mfcc_batch(audios, 16000))
+
+    with torch.no_grad():
+        reference = instance.embed_packed(SimpleNamespace(batch_size=4), *packed)
+
+        for pipeline, method in [(False, 'forward_towers'), (True, 'forward_towers_concurrent')]:
+            forward = getattr(instance, method)
+            calls = []
+
+            def failing(*args):
+                calls.append(args[-2]) # windows in the batch
+                if len(calls) == 2:
+                    raise RuntimeError('DefaultCPUAllocator: not enough memory: you tried to allocate 1 bytes. out of memory')
+                return forward(*args)
+
+            setattr(instance, method, failing)
+            threads = threading.active_count()
+            opt = SimpleNamespace(batch_size=4, pipeline=pipeline)
+            try:
+                feats = instance.embed_packed(opt, *packed)
+            finally:
+                delattr(instance, method)
+
+            # 4 windows, failed 4, then batches of at most 2
+            assert opt.batch_size == 2 and calls[:2] == [4, 4] and max(calls[2:]) == 2
+            assert threading.active_count() == threads
+            for (im_feat, cc_feat), (im_ref, cc_ref) in zip(feats, reference):
+                assert torch.allclose(im_feat, im_ref, rtol=1e-4, atol=1e-3)
+                assert torch.allclose(cc_feat, cc_ref, rtol=1e-4, atol=1e-4)
+
+
+def test_stream_matches_packed():
+    """Embedding from rolling frame buffers gives the in-memory embeddings, for a clip over
+    several batches, a clip with less audio than video and a clip shorter than one batch"""
+
+    instance = SyncNetInstance()
+    instance.__S__ = make_model()
+    opt = SimpleNamespace(batch_size=4)
+
+    rng = numpy.random.RandomState(0)
+    clips = {}
+    for name, n, m in [('batches', 15, 15), ('short_audio', 12, 9), ('short', 7, 7)]:
+        clips[name] = (rng.randint(0, 256, (n, 224, 224, 3)).astype(numpy.uint8), (rng.randn(m*640) * 3000).astype(numpy.int16))
+
+    # ffmpeg pipes replaced by the raw frames and PCM of each clip
+    def open_video_pipe(videofile):
+        frames = clips[videofile][0]
+        return SimpleNamespace(stdout=io.BytesIO(frames.tobytes()), wait=lambda: 0), 224, 224, len(frames)
+
+    def read_audio_pipe(videofile, sample_rate=16000):
+        return sample_rate, clips[videofile][1]
+
+    pipes = syncnet_instance.open_video_pipe, syncnet_instance.read_audio_pipe
+    syncnet_instance.open_video_pipe, syncnet_instance.read_audio_pipe = open_video_pipe, read_audio_pipe
+    try:
+        with torch.no_grad():
+            for name, (frames, audio) in clips.items():
+                im_feat, cc_feat = instance.embed_stream(opt, name)
+                [(im_ref, cc_ref)] = instance.embed_packed(opt, *pack_tracks([frames], [audio], mfcc_batch([audio], 16000)))
+
+                assert im_feat.shape == cc_feat.shape == (min(len(frames), len(audio)//640)-5, 1024)
+                assert torch.allclose(im_feat, im_ref, rtol=1e-4, atol=1e-3)
+                assert torch.allclose(cc_feat, cc_ref, rtol=1e-4, atol=1e-4)
+    finally:
+        syncnet_instance.open_video_pipe, syncnet_instance.read_audio_pipe = pipes
+
+
+def test_feature_file_resumes():
+    """An interrupted extraction to .npy resumes from its progress file and gives the features
+    of extract_feature, also when seeking lands on the wrong frame, and resize_npy keeps the
+    rows written so far"""
+
+    class Interrupted(Exception):
+        pass
+
+    instance = SyncNetInstance()
+    instance.__S__ = make_model()
+    opt = SimpleNamespace(batch_size=4)
+
+    with tempfile.TemporaryDirectory(prefix='syncnet_feature_') as tmp:
+        videofile = os.path.join(tmp, 'track.avi')
+        writer = cv2.VideoWriter(videofile, cv2.VideoWriter_fourcc(*'MJPG'), 25, (224, 224))
+        rng = numpy.random.RandomState(0)
+        for _ in range(14):
+            writer.write(rng.randint(0, 256, (224, 224, 3)).astype(numpy.uint8))
+        writer.release()
+
+        reference = instance.extract_feature(opt, videofile)
+
+        # Stop after the first batch of 4 windows
+        iter_lip_features = instance.iter_lip_features
+        def interrupted(opt, videofile, start=0, digest=None):
+            for item in iter_lip_features(opt, videofile, start, digest):
+                yield item
+                raise Interrupted()
+        instance.iter_lip_features = interrupted
+
+        outfile = os.path.join(tmp, 'feats.npy')
+        try:
+            instance.extract_feature_to_file(opt, videofile, outfile)
+            assert False
+        except Interrupted:
+            pass
+        del instance.iter_lip_features
+
+        with open(outfile+'.json') as f:
+            progress = json.load(f)
+        assert progress['windows'] == 4 and not progress['complete'] and progress['frame'] is not None
+
+        shutil.copy(outfile, outfile+'.interrupted')
+        shutil.copy(outfile+'.json', outfile+'.json.interrupted')
+
+        # Resume with seeks that land where they should, and seeks that land two frames late
+        # while reporting the requested frame, as on some B-frame streams
+        VideoCapture = cv2.VideoCapture
+        for skew, grabs in [(0, 0), (2, 4)]:
+            grabbed = []
+
+            class SkewedCapture():
+                def __init__(self, videofile):
+                    self.cap = VideoCapture(videofile)
+                def set(self, prop, value):
+                    return self.cap.set(prop, value + (skew if prop == cv2.CAP_PROP_POS_FRAMES else 0))
+                def get(self, prop):
+                    return self.cap.get(prop) - (skew if prop == cv2.CAP_PROP_POS_FRAMES else 0)
+                def grab(self):
+                    grabbed.append(True)
+                    return self.cap.grab()
+                def read(self):
+                    return self.cap.read()
+                def release(self):
+                    self.cap.release()
+
+            shutil.copy(outfile+'.interrupted', outfile)
+            shutil.copy(outfile+'.json.interrupted', outfile+'.json')
+
+            cv2.VideoCapture = SkewedCapture
+            try:
+                windows = instance.extract_feature_to_file(opt, videofile, outfile)
+            finally:
+                cv2.VideoCapture = VideoCapture
+
+            assert len(grabbed) == grabs
+            assert windows == len(reference) == 10
+            assert numpy.allclose(numpy.load(outfile), reference.numpy(), rtol=1e-4, atol=1e-3)
+
+        feats = numpy.lib.format.open_memmap(os.path.join(tmp, 'grow.npy'), mode='w+', dtype=numpy.float32, shape=(3, 2))
+        feats[:] = numpy.arange(6).reshape(3, 2)
+        grown = resize_npy(os.path.join(tmp, 'grow.npy'), feats, 8, chunk=2)
+        assert grown.shape == (8, 2) and numpy.array_equal(grown[:3], feats)
+        assert numpy.array_equal(numpy.load(os.path.join(tmp, 'grow.npy'))[:3], numpy.arange(6).reshape(3, 2))
+        assert numpy.array_equal(resize_npy(os.path.join(tmp, 'grow.npy'), grown, 2), numpy.arange(4).reshape(2, 2))
+
+
+def test_monitor_matches_offline():
+    """Frames and PCM pushed in small chunks give the offline lip embeddings, bounded to the ring"""
+
+    model = make_model()
+    frames = numpy.random.RandomState(0).randint(0, 256, (24, 224, 224, 3)).astype(numpy.uint8)
+    audio = (numpy.random.RandomState(1).randn(24*640) * 3000).astype(numpy.int16)
+
+    monitor = SyncNetMonitor(model, vshift=3, window=12, batch_size=4)
+    for t in range(24):
+        estimate = monitor.push([frames[t]], audio[t*640:(t+1)*640])
+    monitor.flush()
+
+    with torch.no_grad():
+        clip = torch.from_numpy(numpy.ascontiguousarray(frames.transpose(3, 0, 1, 2)[None])).float()
+        reference = model.forward_lip_seq(clip)
+
+    assert monitor.nwin == 24 - 5
+    assert monitor.im_ring.get().shape == monitor.cc_ring.get().shape == (12, 1024)
+    assert torch.allclose(monitor.im_ring.get(), reference[7:19], rtol=1e-4, atol=1e-3)
+    assert estimate is not None and len(estimate) == 4
+
+    ring = EmbeddingRing(5)
+    for t in range(0, 40, 3):
+        ring.extend(torch.arange(t, t+3).float()[:, None])
+    assert torch.equal(ring.get()[:, 0], torch.arange(37, 42).float())
+
+
+def test_mfcc_matches_python_speech_features():
+    """The batched MFCC frontend matches python_speech_features.mfcc"""
+
+    rng = numpy.random.RandomState(0)
+    signals = [ (rng.randn(n) * 3000).astype(numpy.int16) for n in [16000, 12345, 400, 100] ]
+    signals.append(numpy.zeros(4000, dtype=numpy.int16))
+
+    batch = mfcc_batch(signals, 16000)
+
+    for signal, feat in zip(signals, batch):
+        reference = python_speech_features.mfcc(signal, 16000).T
+
+        assert feat.shape == reference.shape
+        assert feat.dtype == numpy.float32
+        assert numpy.allclose(feat, reference, rtol=1e-5, atol=1e-3)
+        assert numpy.array_equal(mfcc(signal, 16000), feat)
+
+
+def test_fused_model_matches_unfused():
+    """Folding BatchNorm into the conv/linear layers keeps the embeddings"""
+
+    model = make_model()
+    fused = fuse_bn(model)
+
+    assert not any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for m in fused.modules())
+
+    clip = torch.rand(1, 3, 9, 224, 224) * 255
+    strip = torch.randn(1, 1, 13, 4*5+20) * 10
+
+    with torch.no_grad():
+        assert torch.allclose(fused.forward_lip_seq(clip), model.forward_lip_seq(clip), rtol=1e-4, atol=1e-3)
+        assert torch.allclose(fused.forward_lipfeat_seq(clip), model.forward_lipfeat_seq(clip), rtol=1e-4, atol=1e-3)
+        assert torch.allclose(fused.forward_aud_seq(strip, 6), model.forward_aud_seq(strip, 6), rtol=1e-4, atol=1e-4)
+
+
+def test_exported_graphs_match_eager():
+    """TorchScript and ONNX graphs give the eager embeddings, also for other clip lengths"""
+
+    model = make_model()
+    clip = torch.rand(1, 3, 13, 224, 224) * 255
+    strip = torch.randn(1, 1, 13, 4*7+20) * 10
+
+    try:
+        import onnx, onnxruntime
+        engines = ['torch', 'onnx']
+    except ImportError:
+        engines = ['torch']
+
+    with tempfile.TemporaryDirectory(prefix='syncnet_export_') as tmp:
+        prefix = os.path.join(tmp, 'syncnet')
+        assert load_export_info(prefix) is None
+        export(model, prefix, onnx=('onnx' in engines), info={'weights': 'digest', 'fuse': False})
+        assert load_export_info(prefix) == {'weights': 'digest', 'fuse': False}
+
+        for engine in engines:
+            compiled = load_compiled(prefix, engine=engine)
+
+            with torch.no_grad():
+                assert torch.allclose(compiled.forward_lip_seq(clip), model.forward_lip_seq(clip), rtol=1e-4, atol=1e-3)
+                assert torch.allclose(compiled.forward_lipfeat_seq(clip), model.forward_lipfeat_seq(clip), rtol=1e-4, atol=1e-3)
+                assert torch.allclose(compiled.forward_aud_seq(strip, 8), model.forward_aud_seq(strip, 8), rtol=1e-4, atol=1e-4)
+
+    assert load_compiled(os.path.join(tmp, 'missing')) is None
+
+
+def main():
+    """Run all tests in this file"""
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_')]
+
+    for test in tests:
+        test()
+        print(f"   ✅ {test.__name__}")
+
+    print(f"\n🎉 All {len(tests)} tests passed!")
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
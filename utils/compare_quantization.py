@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Quantization Comparison Script
+Compare SyncNet offsets and confidences of the int8 modes against fp32
+on a reference set of cropped face tracks
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+
+# Add the repository root to the path so we can import the SyncNet modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SyncNetInstance import SyncNetInstance
+
+def score_tracks(opt, tracks, mode, calibration):
+    """Score all tracks with one quantization mode, returns results and elapsed time"""
+    s = SyncNetInstance()
+    s.loadParameters(opt.initial_model, compiled=False)
+
+    if mode != 'fp32':
+        s.quantizeModel(opt, calibration, static=(mode == 'static'))
+
+    tS = time.time()
+    results = s.evaluate_tracks(opt, tracks)
+    elapsed = time.time() - tS
+
+    return [{'offset': int(offset), 'confidence': float(conf)} for offset, conf, _ in results], elapsed
+
+def compare_modes(tracks, scores, times):
+    """Print per-track and summary differences against fp32"""
+
+    reference = scores['fp32']
+
+    print("\n🔍 QUANTIZATION COMPARISON")
+    print("="*60)
+
+    summary = {}
+    for mode, results in scores.items():
+        if mode == 'fp32':
+            continue
+
+        offset_match = sum(r['offset'] == f['offset'] for r, f in zip(results, reference))
+        conf_deltas = [abs(r['confidence'] - f['confidence']) for r, f in zip(results, reference)]
+
+        print(f"\n📊 {mode} vs fp32")
+        print("-"*40)
+        for track, r, f in zip(tracks, results, reference):
+            print(f"  {os.path.basename(track)}: offset {f['offset']:+d} -> {r['offset']:+d}, "
+                  f"conf {f['confidence']:.3f} -> {r['confidence']:.3f} ({r['confidence'] - f['confidence']:+.3f})")
+
+        summary[mode] = {
+            'offset_agreement': offset_match / len(reference),
+            'mean_abs_conf_delta': sum(conf_deltas) / len(conf_deltas),
+            'max_abs_conf_delta': max(conf_deltas),
+            'time_sec': times[mode],
+            'speedup': times['fp32'] / times[mode],
+        }
+
+        print(f"  Offset agreement:     {100*summary[mode]['offset_agreement']:.1f}%")
+        print(f"  Mean |conf delta|:    {summary[mode]['mean_abs_conf_delta']:.3f}")
+        print(f"  Max |conf delta|:     {summary[mode]['max_abs_conf_delta']:.3f}")
+        print(f"  Time: {times[mode]:.2f}s vs {times['fp32']:.2f}s fp32 ({summary[mode]['speedup']:.2f}x)")
+
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare int8 quantized SyncNet against fp32')
+    parser.add_argument('--reference_dir', required=True, help='Directory of cropped face tracks (*.avi) to score')
+    parser.add_argument('--calibration_dir', default='', help='Clips to calibrate static quantization on (default: reference_dir)')
+    parser.add_argument('--calibration_clips', type=int, default=4, help='Number of calibration clips')
+    parser.add_argument('--initial_model', default='data/syncnet_v2.model', help='SyncNet weights')
+    parser.add_argument('--modes', default='dynamic,static', help='Comma separated int8 modes to compare')
+    parser.add_argument('--batch_size', type=int, default=20)
+    parser.add_argument('--vshift', type=int, default=15)
+    parser.add_argument('--output', default='', help='Optional JSON report path')
+
+    opt = parser.parse_args()
+    setattr(opt, 'decode', 'pipe')
+
+    tracks = sorted(glob.glob(os.path.join(opt.reference_dir, '*.avi')))
+    if not tracks:
+        print(f"❌ No .avi tracks found in {opt.reference_dir}")
+        return 1
+
+    calibration = sorted(glob.glob(os.path.join(opt.calibration_dir or opt.reference_dir, '*.avi')))[:opt.calibration_clips]
+
+    scores = {}
+    times = {}
+    for mode in ['fp32'] + opt.modes.split(','):
+        print(f"\n🚀 Scoring {len(tracks)} tracks with {mode}...")
+        scores[mode], times[mode] = score_tracks(opt, tracks, mode, calibration)
+
+    summary = compare_modes(tracks, scores, times)
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump({'tracks': tracks, 'scores': scores, 'summary': summary}, f, indent=2)
+        print(f"\n📁 Report saved to {opt.output}")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())